@@ -0,0 +1,63 @@
+"""
+Compare requests/sec of `get_db` with a per-request engine (the previous behaviour) and the shared engine.
+
+Every simulated request opens a session, runs `SELECT 1` and closes the session.
+"""
+
+import argparse
+import asyncio
+import time
+from collections.abc import AsyncGenerator, Callable
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from lcaplatform_config import connection
+
+
+async def get_db_per_request_engine() -> AsyncGenerator[AsyncSession, None]:
+    engine = connection.create_postgres_engine()
+    session = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)()
+    try:
+        yield session
+    finally:
+        await session.close()
+        await engine.dispose()
+
+
+async def run(dependency: Callable[[], AsyncGenerator[AsyncSession, None]], requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request() -> None:
+        async with semaphore:
+            generator = dependency()
+            session = await anext(generator)
+            await session.exec(text("SELECT 1"))  # type: ignore
+            await generator.aclose()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request() for _ in range(requests)))
+    return requests / (time.perf_counter() - start)
+
+
+async def main(requests: int, concurrency: int) -> None:
+    before = await run(get_db_per_request_engine, requests, concurrency)
+
+    await connection.startup()
+    await run(connection.get_db, concurrency, concurrency)  # fill the pool
+    after = await run(connection.get_db, requests, concurrency)
+    await connection.dispose()
+
+    print(f"per-request engine: {before:10.1f} req/s")
+    print(f"shared engine:      {after:10.1f} req/s")
+    print(f"speed-up:           {after / before:10.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.requests, args.concurrency))
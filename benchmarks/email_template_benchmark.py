@@ -0,0 +1,64 @@
+"""
+Compare the rendering throughput of the precompiled email templates with the previous `str.format` retry loop.
+
+The previous renderer formatted the template again after every `KeyError`, so each missing
+field costs a full formatting attempt and an exception.
+"""
+
+import argparse
+import time
+from collections.abc import Callable
+from typing import Any
+
+from lcaplatform_config.email import TEMPLATES, EmailType
+
+
+def render_with_retries(email_type: EmailType, **kwargs: Any) -> str:
+    message_body = ""
+    is_error = True
+    while is_error:
+        try:
+            message_body = email_type.value.format(**kwargs)
+            is_error = False
+        except KeyError as e:
+            for arg in e.args:
+                kwargs[arg] = ""
+    return message_body
+
+
+def render_compiled(email_type: EmailType, **kwargs: Any) -> str:
+    return TEMPLATES[email_type].render(**kwargs)
+
+
+def run(render: Callable[..., str], email_type: EmailType, kwargs: dict[str, Any], renders: int) -> float:
+    start = time.perf_counter()
+    for _ in range(renders):
+        render(email_type, **kwargs)
+    return renders / (time.perf_counter() - start)
+
+
+def main(renders: int) -> None:
+    cases = {
+        "all fields": {"task": "Facade", "comment": "Please check the U-values"},
+        "one missing": {"task": "Facade"},
+        "all missing": {},
+    }
+    for name, kwargs in cases.items():
+        before = run(render_with_retries, EmailType.TASK_COMMENT, kwargs, renders)
+        after = run(render_compiled, EmailType.TASK_COMMENT, kwargs, renders)
+        print(f"{name:12}: retry loop {before:10.0f}/s, compiled {after:10.0f}/s ({after / before:4.1f}x)")
+
+    template = TEMPLATES[EmailType.TASK_STATUS_CHANGE]
+    contexts = [{"task": f"Task {index}", "status": "done"} for index in range(1000)]
+    start = time.perf_counter()
+    for _ in range(max(renders // 1000, 1)):
+        template.render_many(contexts)
+    print(f"render_many : {max(renders // 1000, 1) * 1000 / (time.perf_counter() - start):10.0f} recipients/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--renders", type=int, default=100_000)
+    args = parser.parse_args()
+
+    main(args.renders)
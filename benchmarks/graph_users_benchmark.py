@@ -0,0 +1,102 @@
+"""
+Time `user.get_users_from_azure` on a cold cache against a local stub of the Graph API.
+
+The stub answers every user and $batch request after a fixed latency, so the run with a
+concurrency of 1 and a batch size of 1 shows the previous sequential behaviour.
+"""
+
+import argparse
+import asyncio
+import time
+
+import httpx
+import uvicorn
+from kiota_abstractions.authentication import AnonymousAuthenticationProvider
+from msgraph import GraphRequestAdapter, GraphServiceClient
+from msgraph_core import GraphClientFactory
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from lcaplatform_config import user
+
+
+def create_stub_graph(latency: float) -> Starlette:
+    def user_body(user_id: str) -> dict:
+        return {
+            "id": user_id,
+            "displayName": f"User {user_id}",
+            "mail": f"{user_id}@example.com",
+            "companyName": "Example",
+        }
+
+    async def get_user(request: Request) -> JSONResponse:
+        await asyncio.sleep(latency)
+        return JSONResponse(user_body(request.path_params["user_id"]))
+
+    async def batch(request: Request) -> JSONResponse:
+        await asyncio.sleep(latency)
+        responses = [
+            {"id": item["id"], "status": 200, "body": user_body(item["url"].split("?")[0].removeprefix("/users/"))}
+            for item in (await request.json())["requests"]
+        ]
+        return JSONResponse({"responses": responses})
+
+    return Starlette(routes=[Route("/v1.0/users/{user_id}", get_user), Route("/v1.0/$batch", batch, methods=["POST"])])
+
+
+def create_graph_client(port: int) -> GraphServiceClient:
+    http_client = GraphClientFactory.create_with_default_middleware(
+        client=httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}/v1.0")
+    )
+    adapter = GraphRequestAdapter(AnonymousAuthenticationProvider(), client=http_client)
+    adapter.base_url = f"http://127.0.0.1:{port}/v1.0"
+    return GraphServiceClient(request_adapter=adapter)
+
+
+async def run(user_ids: list[str], concurrency: int, batch_size: int) -> float:
+    await user.cache.clear()
+    user.settings.GRAPH_MAX_CONCURRENCY = concurrency
+    user.settings.GRAPH_BATCH_SIZE = batch_size
+
+    start = time.perf_counter()
+    users = await user.get_users_from_azure(user_ids)
+    elapsed = time.perf_counter() - start
+
+    assert len(users) == len(user_ids)
+    return elapsed
+
+
+async def main(users: int, latency: float, port: int, concurrency: list[int], batch_sizes: list[int]) -> None:
+    server = uvicorn.Server(uvicorn.Config(create_stub_graph(latency), port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    graph = create_graph_client(port)
+    user.get_graph_client = lambda: graph
+    user_ids = [f"user-{index}" for index in range(users)]
+
+    for batch_size in batch_sizes:
+        for limit in concurrency:
+            elapsed = await run(user_ids, limit, batch_size)
+            print(
+                f"batch size {batch_size:2}, concurrency {limit:3}: "
+                f"{elapsed:6.2f}s for {users} users ({users / elapsed:7.1f} users/s)"
+            )
+
+    server.should_exit = True
+    await server_task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="stub response time in seconds")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 20])
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 20], help="users per $batch request")
+    args = parser.parse_args()
+
+    asyncio.run(main(args.users, args.latency, args.port, args.concurrency, args.batch_size))
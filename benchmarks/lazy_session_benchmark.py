@@ -0,0 +1,75 @@
+"""
+Measure pool occupancy of the GraphQL context sessions with eager and lazy session dependencies.
+
+Simulates a request mix where only a share of the requests runs a query, and reports
+pool checkouts per request and the peak number of checked out connections.
+"""
+
+import argparse
+import asyncio
+import random
+from collections.abc import AsyncGenerator, Callable
+from typing import Any
+
+from sqlalchemy import event, text
+
+from lcaplatform_config import connection
+
+
+class PoolOccupancy:
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak = 0
+
+    def checkout(self, *args: Any) -> None:
+        self.checkouts += 1
+        self.checked_out += 1
+        self.peak = max(self.peak, self.checked_out)
+
+    def checkin(self, *args: Any) -> None:
+        self.checked_out -= 1
+
+
+async def run(
+    dependencies: tuple[Callable[[], AsyncGenerator[Any, None]], ...], requests: int, db_share: float
+) -> PoolOccupancy:
+    occupancy = PoolOccupancy()
+    pool = connection.get_engine().sync_engine.pool
+    event.listen(pool, "checkout", occupancy.checkout)
+    event.listen(pool, "checkin", occupancy.checkin)
+
+    async def request(uses_db: bool) -> None:
+        generators = [dependency() for dependency in dependencies]
+        session, _read_session = [await anext(generator) for generator in generators]
+        if uses_db:
+            await session.exec(text("SELECT 1"))
+        await asyncio.sleep(0.001)  # the rest of the request
+        for generator in generators:
+            await generator.aclose()
+
+    await asyncio.gather(*(request(random.random() < db_share) for _ in range(requests)))
+
+    event.remove(pool, "checkout", occupancy.checkout)
+    event.remove(pool, "checkin", occupancy.checkin)
+    return occupancy
+
+
+async def main(requests: int, db_share: float) -> None:
+    await connection.startup()
+    for name, dependencies in (
+        ("eager", (connection.get_db, connection.get_read_db)),
+        ("lazy", (connection.get_lazy_db, connection.get_lazy_read_db)),
+    ):
+        occupancy = await run(dependencies, requests, db_share)
+        print(f"{name:5}: {occupancy.checkouts / requests:.2f} checkouts/request, peak {occupancy.peak} connections")
+    await connection.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--db-share", type=float, default=0.3, help="share of requests that run a query")
+    args = parser.parse_args()
+
+    asyncio.run(main(args.requests, args.db_share))
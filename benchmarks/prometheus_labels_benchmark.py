@@ -0,0 +1,81 @@
+"""
+Micro-benchmark of the per-request work in `PrometheusMiddleware`: route resolution and metric label lookups.
+
+Compares the linear `get_path` scan with the cached `resolve_path` on an app with many routes,
+and `.labels(...)` lookups per request with the children bound once by the middleware.
+"""
+
+import argparse
+import time
+from collections.abc import Callable
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.types import Scope
+
+from lcaplatform_config.monitoring import (
+    REQUESTS,
+    REQUESTS_IN_PROGRESS,
+    REQUESTS_PROCESSING_TIME,
+    RESPONSES,
+    PrometheusMiddleware,
+)
+
+
+def timed(func: Callable[[], object], iterations: int) -> float:
+    """Return the average microseconds per call"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def create_scope(routes: int) -> tuple[Starlette, Scope]:
+    async def endpoint(request: Request) -> PlainTextResponse:
+        return PlainTextResponse("ok")
+
+    app = Starlette(routes=[Route(f"/route-{index}/{{item_id}}", endpoint) for index in range(routes)])
+    # the last route, the worst case of the linear scan
+    scope = {"type": "http", "method": "GET", "path": f"/route-{routes - 1}/1", "root_path": "", "app": app}
+    return app, scope
+
+
+def main(iterations: int, routes: int) -> None:
+    app, scope = create_scope(routes)
+    middleware = PrometheusMiddleware(app, app_name="benchmark-labels")
+
+    linear = timed(lambda: PrometheusMiddleware.get_path(Request(scope)), iterations)
+    cached = timed(lambda: middleware.resolve_path(scope), iterations)
+    print(f"route resolution, {routes} routes: get_path {linear:7.2f} us, resolve_path {cached:7.2f} us")
+
+    labels = {"method": "GET", "path": "/route/{item_id}", "app_name": "benchmark-labels"}
+
+    def with_labels() -> None:
+        REQUESTS_IN_PROGRESS.labels(**labels).inc()
+        REQUESTS.labels(**labels).inc()
+        REQUESTS_PROCESSING_TIME.labels(**labels).observe(0.01)
+        RESPONSES.labels(status_code=200, **labels).inc()
+        REQUESTS_IN_PROGRESS.labels(**labels).dec()
+
+    def with_children() -> None:
+        requests, requests_in_progress, requests_processing_time = middleware._get_children("GET", "/route/{item_id}")
+        requests_in_progress.inc()
+        requests.inc()
+        requests_processing_time.observe(0.01)
+        middleware._get_responses("GET", "/route/{item_id}", 200).inc()
+        requests_in_progress.dec()
+
+    before = timed(with_labels, iterations)
+    after = timed(with_children, iterations)
+    print(f"metrics per request: labels() {before:7.2f} us, bound children {after:7.2f} us ({before / after:4.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=100_000)
+    parser.add_argument("--routes", type=int, default=100)
+    args = parser.parse_args()
+
+    main(args.iterations, args.routes)
@@ -0,0 +1,110 @@
+"""
+Measure the per-request overhead of `PrometheusMiddleware` against the previous `BaseHTTPMiddleware` version.
+
+Requests are sent in-process through httpx's ASGI transport to a Starlette app with a few
+routes, without a middleware, with the previous middleware and with the current one.
+"""
+
+import argparse
+import asyncio
+import time
+from typing import Any
+
+import httpx
+from opentelemetry import trace
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
+from starlette.types import ASGIApp
+
+from lcaplatform_config.monitoring import (
+    EXCEPTIONS,
+    INFO,
+    REQUESTS,
+    REQUESTS_IN_PROGRESS,
+    REQUESTS_PROCESSING_TIME,
+    RESPONSES,
+    PrometheusMiddleware,
+)
+
+
+class BaseHTTPPrometheusMiddleware(BaseHTTPMiddleware):
+    """The previous implementation, kept for comparison"""
+
+    def __init__(self, app: ASGIApp, app_name: str = "fastapi-app") -> None:
+        super().__init__(app)
+        self.app_name = app_name
+        INFO.labels(app_name=self.app_name).inc()
+
+    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        method = request.method
+        path, is_handled_path = PrometheusMiddleware.get_path(request)
+
+        if not is_handled_path:
+            return await call_next(request)
+
+        REQUESTS_IN_PROGRESS.labels(method=method, path=path, app_name=self.app_name).inc()
+        REQUESTS.labels(method=method, path=path, app_name=self.app_name).inc()
+        before_time = time.perf_counter()
+        try:
+            response = await call_next(request)
+        except BaseException as e:
+            status_code = HTTP_500_INTERNAL_SERVER_ERROR
+            EXCEPTIONS.labels(method=method, path=path, exception_type=type(e).__name__, app_name=self.app_name).inc()
+            raise e from None
+        else:
+            status_code = response.status_code
+            after_time = time.perf_counter()
+            span = trace.get_current_span()
+            trace_id = trace.format_trace_id(span.get_span_context().trace_id)
+
+            REQUESTS_PROCESSING_TIME.labels(method=method, path=path, app_name=self.app_name).observe(
+                after_time - before_time, exemplar={"TraceID": trace_id}
+            )
+        finally:
+            RESPONSES.labels(method=method, path=path, status_code=status_code, app_name=self.app_name).inc()
+            REQUESTS_IN_PROGRESS.labels(method=method, path=path, app_name=self.app_name).dec()
+
+        return response
+
+
+def create_app(middleware: Any, routes: int) -> Starlette:
+    async def endpoint(request: Request) -> PlainTextResponse:
+        return PlainTextResponse("ok")
+
+    app = Starlette(routes=[Route(f"/route-{index}/{{item_id}}", endpoint) for index in range(routes)])
+    if middleware is not None:
+        app.add_middleware(middleware, app_name=f"benchmark-{middleware.__name__}")
+    return app
+
+
+async def run(app: Starlette, requests: int, routes: int) -> float:
+    """Return the average seconds per request"""
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        for index in range(100):  # warm up
+            await client.get(f"/route-{index % routes}/1")
+
+        start = time.perf_counter()
+        for index in range(requests):
+            await client.get(f"/route-{index % routes}/{index}")
+        return (time.perf_counter() - start) / requests
+
+
+async def main(requests: int, routes: int) -> None:
+    baseline = await run(create_app(None, routes), requests, routes)
+    print(f"{'no middleware':30}{baseline * 1e6:8.1f} us/request")
+    for middleware in (BaseHTTPPrometheusMiddleware, PrometheusMiddleware):
+        elapsed = await run(create_app(middleware, routes), requests, routes)
+        print(f"{middleware.__name__:30}{elapsed * 1e6:8.1f} us/request, overhead {(elapsed - baseline) * 1e6:8.1f} us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--routes", type=int, default=20)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.requests, args.routes))
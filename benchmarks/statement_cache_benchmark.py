@@ -0,0 +1,80 @@
+"""
+Measure the effect of the prepared statement and compiled SQL caches on the queries built by `filter_model_query`.
+
+Runs the same filtered queries against a scratch table with the caches disabled and enabled
+and reports the average latency per query. Postgres plans a cached prepared statement only
+once per connection, so the difference is mostly parse and planning time.
+"""
+
+import argparse
+import asyncio
+import time
+
+from pydantic import BaseModel
+from sqlmodel import Field, SQLModel
+
+from lcaplatform_config import connection
+from lcaplatform_config.graphql.input_filters import BaseFilter, FilterOptions, filter_model_query
+
+
+class BenchmarkEntry(SQLModel, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+    name: str
+    project_id: str
+
+
+class BenchmarkEntryFilters(BaseModel, BaseFilter):
+    name: FilterOptions | None = None
+    project_id: FilterOptions | None = None
+
+
+FILTERS = [
+    BenchmarkEntryFilters(project_id=FilterOptions(equal="project-1")),
+    BenchmarkEntryFilters(name=FilterOptions(starts_with="entry-1"), project_id=FilterOptions(equal="project-2")),
+    BenchmarkEntryFilters(project_id=FilterOptions(is_any_of=["project-1", "project-3"])),
+]
+
+
+async def run(queries: int) -> float:
+    engine = connection.create_postgres_engine()
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.execute(
+            BenchmarkEntry.__table__.insert(),  # type: ignore
+            [{"name": f"entry-{i}", "project_id": f"project-{i % 10}"} for i in range(1000)],
+        )
+
+    async with engine.connect() as conn:
+        start = time.perf_counter()
+        for i in range(queries):
+            await conn.execute(filter_model_query(BenchmarkEntry, FILTERS[i % len(FILTERS)]))
+        elapsed = time.perf_counter() - start
+
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.drop_all)
+    await engine.dispose()
+    return elapsed / queries
+
+
+async def main(queries: int) -> None:
+    settings = connection.settings
+    cached = settings.POSTGRES_STATEMENT_CACHE_SIZE, settings.POSTGRES_COMPILED_CACHE_SIZE
+
+    settings.POSTGRES_STATEMENT_CACHE_SIZE, settings.POSTGRES_COMPILED_CACHE_SIZE = 0, 0
+    uncached = await run(queries)
+    settings.POSTGRES_STATEMENT_CACHE_SIZE, settings.POSTGRES_COMPILED_CACHE_SIZE = cached
+    with_cache = await run(queries)
+
+    print(f"without caches: {uncached * 1000:8.3f} ms/query")
+    print(
+        f"with caches:    {with_cache * 1000:8.3f} ms/query (statement cache {cached[0]}, compiled cache {cached[1]})"
+    )
+    print(f"saved:          {(uncached - with_cache) * 1000:8.3f} ms/query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", type=int, default=5000)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.queries))
@@ -0,0 +1,360 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable, Iterable
+from typing import Any, TypeVar
+
+from aiocache.base import BaseCache
+
+from lcaplatform_config.monitoring import (
+    CACHE_HITS,
+    CACHE_MISSES,
+    CACHE_REFRESH_DURATION,
+    CACHE_REFRESH_TRACKED,
+    CACHE_REFRESHES,
+)
+
+MISSING: Any = object()
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class LRUCache:
+    """
+    Bounded in-process cache with a TTL per entry.
+
+    When full, the least recently used entry is evicted. Hits and misses are counted
+    in the `cache_hits_total`/`cache_misses_total` metrics, labelled with the cache name.
+    Entries set with a `stale_ttl` can still be read with `lookup` for that long after they expired.
+    """
+
+    def __init__(self, name: str, maxsize: int) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, tuple[float, float, Any]] = OrderedDict()
+        self._hits = CACHE_HITS.labels(cache=name)
+        self._misses = CACHE_MISSES.labels(cache=name)
+
+    def lookup(self, key: Hashable) -> tuple[Any, bool]:
+        """Return the cached value, or MISSING, and whether it is still fresh"""
+        entry = self._data.get(key)
+        now = time.monotonic()
+        if entry is None or entry[1] <= now:
+            if entry is not None:
+                del self._data[key]
+            self._misses.inc()
+            return MISSING, False
+
+        self._data.move_to_end(key)
+        self._hits.inc()
+        return entry[2], entry[0] > now
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """Return the cached value, or `default` (MISSING unless given) when absent or expired"""
+        entry = self._data.get(key)
+        now = time.monotonic()
+        if entry is None or entry[0] <= now:
+            if entry is not None and entry[1] <= now:
+                del self._data[key]
+            self._misses.inc()
+            return default
+
+        self._data.move_to_end(key)
+        self._hits.inc()
+        return entry[2]
+
+    def set(self, key: Hashable, value: Any, ttl: float, stale_ttl: float = 0) -> None:
+        expires = time.monotonic() + ttl
+        self._data[key] = (expires, expires + stale_ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class TieredCache:
+    """
+    Async cache with a bounded in-process LRUCache in front of an optional shared aiocache backend, e.g. Redis.
+
+    Reads try the in-process tier first and fill it from the shared one. Writes go to both tiers.
+    Entries stay in the in-process tier for at most `local_ttl` when there is a shared backend,
+    so changes made by other workers show up after that long. The TTL of a namespace is taken
+    from `ttls` when not given. The methods follow the aiocache API for the parts in use.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        backend: BaseCache | None = None,
+        ttls: dict[str, float] | None = None,
+        local_ttl: float | None = None,
+    ) -> None:
+        self.local = LRUCache(name, maxsize)
+        self.backend = backend
+        self.ttls = ttls or {}
+        self.local_ttl = local_ttl
+        self._shared_hits = CACHE_HITS.labels(cache=f"{name}_shared")
+        self._shared_misses = CACHE_MISSES.labels(cache=f"{name}_shared")
+
+    def _ttl(self, ttl: float | None, namespace: str | None) -> float | None:
+        return ttl if ttl is not None else self.ttls.get(namespace or "")
+
+    def _set_local(self, key: str, value: Any, ttl: float | None, namespace: str | None) -> None:
+        if value is None:
+            return
+        local_ttl = ttl if ttl is not None else float("inf")
+        if self.backend is not None and self.local_ttl is not None:
+            local_ttl = min(local_ttl, self.local_ttl)
+        self.local.set((namespace, key), value, ttl=local_ttl)
+
+    async def get(self, key: str, default: Any = None, namespace: str | None = None) -> Any:
+        value = (await self.multi_get([key], namespace=namespace))[0]
+        return default if value is None else value
+
+    async def multi_get(self, keys: Iterable[str], namespace: str | None = None) -> list[Any]:
+        """Return the cached values in the order of `keys`, None for keys that aren't cached"""
+        keys = list(keys)
+        values = [self.local.get((namespace, key), None) for key in keys]
+        missing = [index for index, value in enumerate(values) if value is None]
+        if not missing or self.backend is None:
+            return values
+
+        shared = await self.backend.multi_get([keys[index] for index in missing], namespace=namespace)
+        ttl = self._ttl(None, namespace)
+        for index, value in zip(missing, shared):
+            if value is None:
+                self._shared_misses.inc()
+                continue
+            self._shared_hits.inc()
+            values[index] = value
+            self._set_local(keys[index], value, ttl, namespace)
+        return values
+
+    async def set(self, key: str, value: Any, ttl: float | None = None, namespace: str | None = None) -> bool:
+        ttl = self._ttl(ttl, namespace)
+        if self.backend is not None:
+            await self.backend.set(key, value, ttl=ttl, namespace=namespace)
+        self._set_local(key, value, ttl, namespace)
+        return True
+
+    async def add(self, key: str, value: Any, ttl: float | None = None, namespace: str | None = None) -> bool:
+        """Like `set`, but raises ValueError when the key is already cached in the shared backend"""
+        ttl = self._ttl(ttl, namespace)
+        if self.backend is not None:
+            await self.backend.add(key, value, ttl=ttl, namespace=namespace)
+        self._set_local(key, value, ttl, namespace)
+        return True
+
+    async def multi_set(
+        self, pairs: Iterable[tuple[str, Any]], ttl: float | None = None, namespace: str | None = None
+    ) -> bool:
+        pairs = list(pairs)
+        ttl = self._ttl(ttl, namespace)
+        if self.backend is not None and pairs:
+            await self.backend.multi_set(pairs, ttl=ttl, namespace=namespace)
+        for key, value in pairs:
+            self._set_local(key, value, ttl, namespace)
+        return True
+
+    async def delete(self, key: str, namespace: str | None = None) -> int:
+        self.local.delete((namespace, key))
+        if self.backend is not None:
+            return int(await self.backend.delete(key, namespace=namespace))
+        return 1
+
+    async def clear(self, namespace: str | None = None) -> bool:
+        """Clear a namespace, or all namespaces with a TTL when none is given. Never flushes the whole shared backend."""
+        if namespace:
+            for local_key in [local_key for local_key in self.local._data if local_key[0] == namespace]:  # type: ignore[index]
+                self.local.delete(local_key)
+        else:
+            self.local.clear()
+        if self.backend is not None:
+            for name in [namespace] if namespace else self.ttls:
+                await self.backend.clear(namespace=name)
+        return True
+
+    async def close(self) -> None:
+        if self.backend is not None:
+            await self.backend.close()
+
+
+class RefreshAhead:
+    """
+    Refreshes the hot entries of a TieredCache namespace in the background before they expire.
+
+    Callers `track` the keys they write and `touch` the keys they read. `refresh` refetches the keys
+    read within the last `window` seconds that expire within `ahead` seconds, `batch_size` keys per
+    `fetch` call with at most `concurrency` calls at a time, and writes them back to the cache.
+    At most `maxsize` keys are tracked, the least recently written are dropped first.
+    Unless `enabled`, nothing is refreshed and `track` and `touch` do nothing.
+    """
+
+    def __init__(
+        self,
+        cache: TieredCache,
+        namespace: str,
+        fetch: Callable[[list[str]], Awaitable[dict[str, Any]]],
+        window: float,
+        ahead: float,
+        maxsize: int,
+        batch_size: int = 20,
+        concurrency: int = 2,
+        enabled: bool = True,
+    ) -> None:
+        self.cache = cache
+        self.namespace = namespace
+        self.fetch = fetch
+        self.window = window
+        self.ahead = ahead
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.enabled = enabled
+        # key -> [expires at, last read at]
+        self._entries: OrderedDict[str, list[float]] = OrderedDict()
+        self._tracked = CACHE_REFRESH_TRACKED.labels(cache=namespace)
+        self._refreshed = CACHE_REFRESHES.labels(cache=namespace, result="refreshed")
+        self._failed = CACHE_REFRESHES.labels(cache=namespace, result="failed")
+        self._duration = CACHE_REFRESH_DURATION.labels(cache=namespace)
+
+    def track(self, keys: Iterable[str]) -> None:
+        ttl = self.cache.ttls.get(self.namespace)
+        if not self.enabled or ttl is None:
+            return
+        now = time.monotonic()
+        for key in keys:
+            entry = self._entries.get(key)
+            self._entries[key] = [now + ttl, entry[1] if entry else 0]
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        self._tracked.set(len(self._entries))
+
+    def touch(self, keys: Iterable[str]) -> None:
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[1] = now
+
+    def due(self) -> list[str]:
+        """Return the hot keys that expire soon, and stop tracking expired keys that weren't read lately"""
+        now = time.monotonic()
+        due = []
+        for key, (expires_at, read_at) in list(self._entries.items()):
+            if read_at >= now - self.window:
+                if expires_at - now <= self.ahead:
+                    due.append(key)
+            elif expires_at <= now:
+                del self._entries[key]
+        self._tracked.set(len(self._entries))
+        return due
+
+    async def refresh(self) -> int:
+        """Refetch the keys that are due, returning how many were refreshed"""
+        keys = self.due()
+        if not keys:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def refresh_chunk(chunk: list[str]) -> int:
+            async with semaphore:
+                try:
+                    values = await self.fetch(chunk)
+                except Exception as e:
+                    logger.warning(f"Failed to refresh {len(chunk)} {self.namespace} cache entries: {e}")
+                    values = {}
+            pairs = [(key, value) for key, value in values.items() if value is not None]
+            if pairs:
+                await self.cache.multi_set(pairs, namespace=self.namespace)
+                self.track(key for key, _ in pairs)
+            self._refreshed.inc(len(pairs))
+            self._failed.inc(len(chunk) - len(pairs))
+            return len(pairs)
+
+        with self._duration.time():
+            chunks = [keys[index : index + self.batch_size] for index in range(0, len(keys), self.batch_size)]
+            return sum(await asyncio.gather(*(refresh_chunk(chunk) for chunk in chunks)))
+
+    async def run(self, interval: float) -> None:
+        """Refresh every `interval` seconds until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception(f"Refreshing the {self.namespace} cache failed")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls: while a call for a key is in flight, callers with the same key
+    await its result instead of starting their own.
+    """
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    def start(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> "asyncio.Future[T]":
+        """Start the call for the key, or return the one in flight. The result doesn't have to be awaited."""
+        future = self._calls.get(key)
+        if future is None:
+            future = self._calls[key] = asyncio.ensure_future(func())
+            future.add_done_callback(functools.partial(self._done, key))
+        return future
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        # a cancelled caller must not cancel the call for the others
+        return await asyncio.shield(self.start(key, func))
+
+    def _done(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            future.exception()  # retrieved here in case no caller is left to await it
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+def _default_key(*args: Any, **kwargs: Any) -> Hashable:
+    return args, tuple(sorted(kwargs.items()))
+
+
+def single_flight(
+    key: Callable[..., Hashable] = _default_key,
+) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+    """
+    Decorate a coroutine function so that concurrent calls with the same key share one call.
+
+    `key` is called with the arguments of the function, by default all arguments form the key.
+    """
+
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        flights = SingleFlight()
+
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            return await flights.run(key(*args, **kwargs), lambda: func(*args, **kwargs))
+
+        wrapper.flights = flights  # type: ignore
+        return wrapper
+
+    return decorator
@@ -4,8 +4,10 @@ from pydantic import AnyHttpUrl, ConfigDict, PostgresDsn, field_validator, model
 from pydantic_settings import BaseSettings
 
 
-def convert_env_to_list(cls, v: str | list[str]) -> list[str] | str:  # type: ignore
-    if isinstance(v, str) and not v.startswith("["):
+def convert_env_to_list(cls, v: str | list[str] | None) -> list[str] | str | None:  # type: ignore
+    if v is None:
+        return v
+    elif isinstance(v, str) and not v.startswith("["):
         return [i.strip() for i in v.split(",")]
     elif isinstance(v, list):
         return v
@@ -33,6 +35,21 @@ class AzureSettings(BaseSettings):
     AAD_TENANT_ID: str
     AAD_OPENAPI_CLIENT_ID: str | None
     AAD_TEST_CLIENT_SECRET: str | None = None
+    GRAPH_MAX_CONCURRENCY: int = 10
+    GRAPH_MAX_RETRIES: int = 3
+    GRAPH_RETRY_BACKOFF: float = 1
+    GRAPH_MAX_RETRY_DELAY: float = 180  # longer Retry-After waits fail the request instead of stalling it
+    GRAPH_BATCH_SIZE: int = 20  # users per JSON $batch request, at most 20; 1 disables batching
+    USER_CACHE_URL: str | None = None  # shared user cache, e.g. "redis://redis:6379/0"; in-process only when unset
+    USER_CACHE_MAX_SIZE: int = 10_000  # entries in the in-process tier
+    USER_CACHE_LOCAL_TTL: float = 60  # longest an entry stays in the in-process tier when there is a shared cache
+    AZURE_USERS_CACHE_TTL: float = 300
+    AZURE_EMAILS_CACHE_TTL: float = 300
+    USER_REFRESH_AHEAD: bool = False  # refresh hot cached users in the background before they expire
+    USER_REFRESH_INTERVAL: float = 30
+    USER_REFRESH_WINDOW: float = 300  # users read within this long are refreshed
+    USER_REFRESH_BEFORE: float = 60  # refresh users expiring within this long, keep above USER_REFRESH_INTERVAL
+    USER_REFRESH_CONCURRENCY: int = 2  # bulk fetches running at a time
 
     # configuration
     model_config = ConfigDict(case_sensitive=True)  # type: ignore
@@ -47,8 +64,17 @@ class PostgresSettings(BaseSettings):
     POSTGRES_SSL: bool = False
     POSTGRES_MAX_OVERFLOW: int = 30
     POSTGRES_POOL_SIZE: int = 20
+    POSTGRES_REPLICA_HOSTS: str | None = None  # comma separated "host" or "host:port" of read replicas
+    POSTGRES_REPLICA_RETRY_SECONDS: float = 5
+    POSTGRES_REPLICA_MAX_RETRY_SECONDS: float = 300
+    POSTGRES_STATEMENT_CACHE_SIZE: int = 100  # prepared statements cached per connection
+    POSTGRES_COMPILED_CACHE_SIZE: int = 500  # SQLAlchemy's cache of compiled SQL strings
+    POSTGRES_PGBOUNCER: bool = False  # no named prepared statements, for pgbouncer in transaction mode
     SQLALCHEMY_DATABASE_URI: PostgresDsn | None = None
 
+    # validators
+    _convert_replicas_to_list = field_validator("POSTGRES_REPLICA_HOSTS")(convert_env_to_list)
+
     @model_validator(mode="before")
     @classmethod
     def assemble_db_connection(cls, data: Any) -> Any:
@@ -74,6 +100,9 @@ class EmailSettings(BaseSettings):
     EMAIL_NOTIFICATION_FROM: str
     INTERNAL_EMAIL_DOMAINS_LIST: str | None = None
     DEFAULT_AD_FQDN: str
+    EMAIL_MAX_WORKERS: int = 4  # threads sending emails at a time
+    EMAIL_QUEUE_MAX_RETRIES: int = 3
+    EMAIL_QUEUE_RETRY_BACKOFF: float = 1
 
     # validators
     _convert_to_list = field_validator("INTERNAL_EMAIL_DOMAINS_LIST")(convert_env_to_list)
@@ -86,13 +115,41 @@ class MetricsSettings(BaseSettings):
     OTLP_GRPC_ENDPOINT: AnyHttpUrl = "http://tempo-distributor.monitoring:4317"  # type: ignore
     ENABLE_METRICS: bool = True
     ENABLE_TELEMETRY: bool = True
+    METRICS_CACHE_INTERVAL: float = 1
+    METRICS_GZIP: bool = True
+    OTLP_SAMPLE_RATIO: float = 1
+    # keeping errors or slow spans while sampling records every span, only their export is saved
+    OTLP_KEEP_ERRORS: bool = False
+    OTLP_SLOW_SPAN_THRESHOLD: float | None = None
+    OTLP_MAX_QUEUE_SIZE: int = 2048
+    OTLP_MAX_EXPORT_BATCH_SIZE: int = 512
+    OTLP_SCHEDULE_DELAY: int = 5000
+    OTLP_EXCLUDED_URLS: str = "/metrics$,/health"
+    GRAPHQL_PROFILING_SAMPLE_RATE: float = 1
+    GRAPHQL_N_PLUS_ONE_THRESHOLD: int = 50
 
     # configuration
     model_config = ConfigDict(case_sensitive=True)  # type: ignore
 
 
-class Settings(ServerSettings, AzureSettings, PostgresSettings, EmailSettings, MetricsSettings):
+class RouterSettings(BaseSettings):
     ROUTER_URL: AnyHttpUrl
+    ROUTER_HTTP2: bool = True
+    ROUTER_MAX_CONNECTIONS: int = 100
+    ROUTER_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    ROUTER_KEEPALIVE_EXPIRY: float = 30
+    ROUTER_TIMEOUT: float = 10
+    ROUTER_CONNECT_TIMEOUT: float = 5
+    PERMISSION_CACHE_TTL: float = 60
+    PERMISSION_CACHE_NEGATIVE_TTL: float = 10
+    PERMISSION_CACHE_STALE_TTL: float = 0  # serve expired results this long while they are refreshed
+    PERMISSION_CACHE_MAX_SIZE: int = 10_000
+
+    # configuration
+    model_config = ConfigDict(case_sensitive=True)  # type: ignore
+
+
+class Settings(ServerSettings, AzureSettings, PostgresSettings, EmailSettings, MetricsSettings, RouterSettings):
     AAD_GRAPH_SECRET: str
 
     # configuration
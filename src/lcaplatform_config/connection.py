@@ -1,12 +1,27 @@
-from asyncio import current_task
+import asyncio
+import itertools
+import logging
+import time
+import uuid
 from typing import Any
 from collections.abc import AsyncGenerator
 
 from pydantic import PostgresDsn
-from sqlalchemy.ext.asyncio import async_scoped_session, async_sessionmaker, create_async_engine, AsyncEngine
-from sqlmodel import create_engine
+from sqlalchemy import Engine, event, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine, AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, ConnectionPoolEntry
+from sqlmodel import Session, create_engine
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from lcaplatform_config.context import LazySession
+from lcaplatform_config.monitoring import (
+    DB_CONNECTION_AGE,
+    DB_POOL_CHECKED_OUT,
+    DB_POOL_CHECKOUT_WAIT_TIME,
+    DB_POOL_OVERFLOW,
+    DB_STATEMENT_DURATION,
+)
+
 try:
     from core.config import settings
 except (ImportError, ModuleNotFoundError):
@@ -14,17 +29,191 @@ except (ImportError, ModuleNotFoundError):
 
     settings = config.Settings()
 
+_engine: AsyncEngine | None = None
+_engine_loop: asyncio.AbstractEventLoop | None = None
+_engine_overridden: bool = False
+_session_factory: async_sessionmaker[AsyncSession] | None = None
+_read_session_factory: async_sessionmaker[AsyncSession] | None = None
+_replicas: list["Replica"] | None = None
+_replica_counter = itertools.count()
+
+logger = logging.getLogger(__name__)
+
+STATEMENT_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "BEGIN", "COMMIT", "ROLLBACK"}
+
+
+class Replica:
+    """
+    A read replica with its own connection pool.
+
+    A replica that fails to connect is skipped until its backoff has passed.
+    The backoff doubles with every consecutive failure and is reset by the next successful connection.
+    """
+
+    def __init__(self, host: str, engine: AsyncEngine) -> None:
+        self.host = host
+        self.engine = engine
+        self.read_engine = engine.execution_options(postgresql_readonly=True)
+        self.session_factory = _create_session_factory(
+            self.read_engine, sync_session_class=ReplicaSession, replica=self
+        )
+        self.failures = 0
+        self.retry_at = 0.0
+
+        event.listen(engine.sync_engine, "do_connect", self._connect)
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.retry_at
+
+    def mark_unhealthy(self) -> None:
+        backoff = min(
+            settings.POSTGRES_REPLICA_RETRY_SECONDS * 2**self.failures, settings.POSTGRES_REPLICA_MAX_RETRY_SECONDS
+        )
+        self.failures += 1
+        self.retry_at = time.monotonic() + backoff
+        logger.warning(f"Read replica {self.host} is unhealthy, retrying in {backoff}s")
+
+    def mark_healthy(self) -> None:
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def _connect(self, dialect: Any, conn_rec: Any, cargs: Any, cparams: Any) -> Any:
+        try:
+            dbapi_connection = dialect.connect(*cargs, **cparams)
+        except Exception:
+            self.mark_unhealthy()
+            raise
+        self.mark_healthy()
+        return dbapi_connection
+
+
+class ReplicaSession(Session):
+    """
+    Read session bound to a replica, falling back to the primary when the replica can't be reached.
+
+    The replica connection is opened with the first statement. If that connect fails the replica is
+    marked unhealthy by its engine and the session continues on the primary, still read-only,
+    so the request is served instead of failing.
+    """
+
+    def __init__(self, *args: Any, replica: Replica, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.replica = replica
+        self._fallback_bind: Engine | None = None
+        self._replica_checked = False
+
+    def get_bind(self, *args: Any, **kwargs: Any) -> Any:
+        if self._fallback_bind is not None:
+            return self._fallback_bind
+
+        bind = super().get_bind(*args, **kwargs)
+        if not self._replica_checked:
+            self._replica_checked = True
+            try:
+                self.connection(bind_arguments={"bind": bind})
+            except Exception:
+                if self.replica.healthy:
+                    raise
+                logger.warning(f"Read replica {self.replica.host} can't be reached, using the primary")
+                self._fallback_bind = get_engine().execution_options(postgresql_readonly=True).sync_engine
+                return self._fallback_bind
+        return bind
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Async queue pool reporting how long callers wait for a connection, labelled by its logging name"""
+
+    def _do_get(self) -> ConnectionPoolEntry:
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT_TIME.labels(pool=self.logging_name or "").observe(time.perf_counter() - start)
+
+
+def instrument_engine(engine: AsyncEngine | Engine, name: str) -> None:
+    """Feed the pool and statement metrics from monitoring.py with the events of the engine"""
+    sync_engine = engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+    checked_out = 0
+
+    def update_pool_gauges(change: int) -> None:
+        nonlocal checked_out
+        checked_out += change
+        DB_POOL_CHECKED_OUT.labels(pool=name).set(checked_out)
+        DB_POOL_OVERFLOW.labels(pool=name).set(max(checked_out - sync_engine.pool.size(), 0))  # type: ignore
 
-def create_postgres_engine(as_async: bool = True) -> AsyncEngine | Any:
+    def on_connect(dbapi_connection: Any, connection_record: Any) -> None:
+        connection_record.info["connected_at"] = time.monotonic()
+
+    def on_checkout(dbapi_connection: Any, connection_record: Any, connection_proxy: Any) -> None:
+        connected_at = connection_record.info.get("connected_at")
+        if connected_at is not None:
+            DB_CONNECTION_AGE.labels(pool=name).observe(time.monotonic() - connected_at)
+        update_pool_gauges(1)
+
+    def on_checkin(dbapi_connection: Any, connection_record: Any) -> None:
+        update_pool_gauges(-1)
+
+    def before_cursor_execute(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+        conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+        duration = time.perf_counter() - conn.info["statement_start"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+        if operation not in STATEMENT_OPERATIONS:
+            operation = "OTHER"
+        DB_STATEMENT_DURATION.labels(pool=name, operation=operation).observe(duration)
+
+    def handle_error(context: Any) -> None:
+        # failed statements never reach after_cursor_execute
+        if context.connection is not None and context.connection.info.get("statement_start"):
+            context.connection.info["statement_start"].pop()
+
+    event.listen(sync_engine, "connect", on_connect)
+    event.listen(sync_engine, "checkout", on_checkout)
+    event.listen(sync_engine, "checkin", on_checkin)
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(sync_engine, "handle_error", handle_error)
+
+
+def _connect_args() -> dict[str, Any]:
+    """asyncpg connection arguments, including the prepared statement caches"""
+    if settings.POSTGRES_PGBOUNCER:
+        # pgbouncer may hand each transaction to another server connection,
+        # so statements can't be cached and their names must never collide
+        return {
+            "ssl": settings.POSTGRES_SSL,
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+        }
+    return {
+        "ssl": settings.POSTGRES_SSL,
+        "statement_cache_size": settings.POSTGRES_STATEMENT_CACHE_SIZE,
+        "prepared_statement_cache_size": settings.POSTGRES_STATEMENT_CACHE_SIZE,
+    }
+
+
+def create_postgres_engine(as_async: bool = True, url: str | None = None) -> AsyncEngine | Any:
     if as_async:
-        return create_async_engine(
-            str(settings.SQLALCHEMY_DATABASE_URI),
+        url = url or str(settings.SQLALCHEMY_DATABASE_URI)
+        name = make_url(url).host or ""
+        engine = create_async_engine(
+            url,
             pool_pre_ping=True,
             future=True,
             pool_size=settings.POSTGRES_POOL_SIZE,
             max_overflow=settings.POSTGRES_MAX_OVERFLOW,
-            connect_args={"ssl": settings.POSTGRES_SSL},
+            query_cache_size=settings.POSTGRES_COMPILED_CACHE_SIZE,
+            connect_args=_connect_args(),
+            poolclass=InstrumentedQueuePool if settings.ENABLE_METRICS else AsyncAdaptedQueuePool,
+            pool_logging_name=name,
         )
+        if settings.ENABLE_METRICS:
+            instrument_engine(engine, name)
+        return engine
     else:
         return create_engine(
             str(
@@ -41,16 +230,189 @@ def create_postgres_engine(as_async: bool = True) -> AsyncEngine | Any:
         )
 
 
-async def get_db() -> AsyncGenerator[AsyncSession, None]:
-    local_session = async_sessionmaker(
+def _running_loop() -> asyncio.AbstractEventLoop | None:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _create_session_factory(engine: AsyncEngine, **kwargs: Any) -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(
         autocommit=False,
         autoflush=False,
-        bind=create_postgres_engine(),
+        bind=engine,
         class_=AsyncSession,
         expire_on_commit=False,
+        **kwargs,
     )
-    AsyncScopedSession = async_scoped_session(local_session, scopefunc=current_task)
-    session = AsyncScopedSession()
+
+
+def _replica_url(host: str) -> str:
+    host, _, port = host.partition(":")
+    url = make_url(str(settings.SQLALCHEMY_DATABASE_URI)).set(host=host, port=int(port) if port else None)
+    return url.render_as_string(hide_password=False)
+
+
+def _reset_engines(close: bool) -> list[AsyncEngine]:
+    """Forget the primary and replica engines, returning them. Without `close` only their pools are dropped."""
+    global _engine, _engine_loop, _engine_overridden, _session_factory, _read_session_factory, _replicas
+
+    engines = [replica.engine for replica in _replicas or []]
+    if _engine is not None and not _engine_overridden:
+        engines.append(_engine)
+    if not close:
+        for engine in engines:
+            # the connections belong to another loop and can't be closed from this one, so only drop them
+            engine.sync_engine.dispose(close=False)
+
+    _engine = None
+    _engine_loop = None
+    _engine_overridden = False
+    _session_factory = None
+    _read_session_factory = None
+    _replicas = None
+    return engines
+
+
+def get_engine() -> AsyncEngine:
+    """
+    Return the process-wide async engine, creating it on first use.
+
+    asyncpg connections are bound to the event loop that opened them, so the engine is rebuilt
+    when it is requested from a different loop than the one it was created in.
+    An engine installed with `override_engine` is always returned as is.
+    """
+    global _engine, _engine_loop
+
+    loop = _running_loop()
+    if _engine is not None and (_engine_overridden or _engine_loop is loop):
+        return _engine
+
+    _reset_engines(close=False)
+    _engine = create_postgres_engine()
+    _engine_loop = loop
+    return _engine
+
+
+def get_session_factory() -> async_sessionmaker[AsyncSession]:
+    """Return the session factory bound to the process-wide engine"""
+    global _session_factory
+
+    engine = get_engine()
+    if _session_factory is None:
+        _session_factory = _create_session_factory(engine)
+    return _session_factory
+
+
+def get_replicas() -> list[Replica]:
+    """Return the read replicas configured in POSTGRES_REPLICA_HOSTS, sharing the lifetime of the primary engine"""
+    global _replicas
+
+    get_engine()
+    if _replicas is None:
+        _replicas = [
+            Replica(host, create_postgres_engine(url=_replica_url(host)))
+            for host in settings.POSTGRES_REPLICA_HOSTS or []
+        ]
+    return _replicas
+
+
+def get_read_session_factory() -> async_sessionmaker[AsyncSession]:
+    """
+    Return a session factory for read-only sessions.
+
+    Healthy replicas are picked round-robin. Without any healthy replica the primary is used,
+    still in read-only transactions, so writes never succeed through a read session.
+    """
+    global _read_session_factory
+
+    replicas = get_replicas()
+    for _ in range(len(replicas)):
+        replica = replicas[next(_replica_counter) % len(replicas)]
+        if replica.healthy:
+            return replica.session_factory
+
+    if _read_session_factory is None:
+        _read_session_factory = _create_session_factory(get_engine().execution_options(postgresql_readonly=True))
+    return _read_session_factory
+
+
+def override_engine(engine: AsyncEngine | None) -> None:
+    """
+    Replace the process-wide engine, e.g. with one pointing to a test database.
+
+    Passing None removes the override and the default engine is created again on next use.
+    The overridden engine is not disposed by this function. Replicas are created again on next use.
+    """
+    global _engine, _engine_loop, _engine_overridden
+
+    _reset_engines(close=False)
+    _engine = engine
+    _engine_loop = _running_loop()
+    _engine_overridden = engine is not None
+
+
+async def startup() -> AsyncEngine:
+    """
+    Create the process-wide engine inside the running event loop.
+
+    Meant to be called from the FastAPI lifespan together with `dispose`:
+
+        @asynccontextmanager
+        async def lifespan(app: FastAPI):
+            await connection.startup()
+            yield
+            await connection.dispose()
+    """
+    return get_engine()
+
+
+async def dispose() -> None:
+    """Close all pooled connections of the process-wide engine and the replicas and forget them"""
+    overridden = _engine if _engine_overridden else None
+
+    for engine in _reset_engines(close=True):
+        await engine.dispose()
+    if overridden is not None:
+        await overridden.dispose()
+
+
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
+    session = get_session_factory()()
+    try:
+        yield session
+    except Exception as e:
+        await session.rollback()
+        raise e
+    finally:
+        await session.close()
+
+
+async def get_read_db() -> AsyncGenerator[AsyncSession, None]:
+    session = get_read_session_factory()()
+    try:
+        yield session
+    except Exception as e:
+        await session.rollback()
+        raise e
+    finally:
+        await session.close()
+
+
+async def get_lazy_db() -> AsyncGenerator[LazySession, None]:
+    session = LazySession(get_session_factory)
+    try:
+        yield session
+    except Exception as e:
+        await session.rollback()
+        raise e
+    finally:
+        await session.close()
+
+
+async def get_lazy_read_db() -> AsyncGenerator[LazySession, None]:
+    session = LazySession(get_read_session_factory)
     try:
         yield session
     except Exception as e:
@@ -1,14 +1,64 @@
+from collections.abc import Callable
+from typing import Any
+
 from fastapi_azure_auth.user import User
+from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlmodel.ext.asyncio.session import AsyncSession
 from strawberry.types import Info
 
 
+class LazySession:
+    """
+    Stand-in for a session that is only created on first use.
+
+    Attribute access is forwarded to the real session, so it can be used like an AsyncSession.
+    Requests that never use it don't create a session, pick a replica or check out a connection.
+    """
+
+    def __init__(self, get_session_factory: Callable[[], async_sessionmaker[AsyncSession]]) -> None:
+        self._get_session_factory = get_session_factory
+        self._session: AsyncSession | None = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._session is not None
+
+    def get(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._get_session_factory()()
+        return self._session
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    async def rollback(self) -> None:
+        if self._session is not None:
+            await self._session.rollback()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
 def get_user(info: Info) -> User:
     return info.context.get("user")  # type: ignore
 
 
+def _open(session: AsyncSession | LazySession | None) -> AsyncSession:
+    if isinstance(session, LazySession):
+        return session.get()
+    return session  # type: ignore
+
+
 def get_session(info: Info) -> AsyncSession:
-    return info.context.get("session")  # type: ignore
+    return _open(info.context.get("session"))
+
+
+def get_read_session(info: Info) -> AsyncSession:
+    """Session on a read replica, falling back to the primary session for contexts without one"""
+    return _open(info.context.get("read_session") or info.context.get("session"))
 
 
 def get_token(info: Info) -> str:
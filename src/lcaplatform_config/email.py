@@ -1,10 +1,20 @@
+import asyncio
+import html
 import logging
+import time
+from collections.abc import Iterable, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
+from string import Formatter
+from typing import Any
 
 from requests import Response  # type: ignore
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 
+from lcaplatform_config.monitoring import EMAIL_QUEUE_DEPTH, EMAIL_QUEUE_LATENCY, EMAILS_SENT
+
 try:
     from core.config import settings
 except (ImportError, ModuleNotFoundError):
@@ -14,6 +24,14 @@ except (ImportError, ModuleNotFoundError):
 
 logger = logging.getLogger(__name__)
 
+_sendgrid_client: SendGridAPIClient | None = None
+_executor: ThreadPoolExecutor | None = None
+
+# most personalizations SendGrid accepts in one request
+SENDGRID_MAX_PERSONALIZATIONS = 1000
+# rate limited or temporarily unavailable
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
 
 class EmailType(Enum):
     INVITE_TO_LCA = (
@@ -43,6 +61,87 @@ class EmailType(Enum):
     )
 
 
+HTML_SPECIAL_CHARACTERS = frozenset("&<>\"'")
+
+
+class EmailTemplate:
+    """
+    A `str.format` template parsed once into its literal text and fields.
+
+    Rendering fills all fields in one pass, missing fields are left empty and values are HTML-escaped.
+    """
+
+    def __init__(self, template: str) -> None:
+        self.formatter = Formatter()
+        self.parts = list(self.formatter.parse(template))
+        self.fields = frozenset(field for _, field, _, _ in self.parts if field is not None)
+
+    def render(self, **kwargs: Any) -> str:
+        parts = []
+        for literal, name, spec, conversion in self.parts:
+            parts.append(literal)
+            if name in kwargs:
+                value = kwargs[name]
+                if conversion:
+                    value = self.formatter.convert_field(value, conversion)
+                if spec or not isinstance(value, str):
+                    value = format(value, spec or "")
+                parts.append(value if HTML_SPECIAL_CHARACTERS.isdisjoint(value) else html.escape(value))
+        return "".join(parts)
+
+    def render_many(self, contexts: Iterable[Mapping[str, Any]]) -> list[str]:
+        """Render the template once per context, e.g. once per recipient"""
+        return [self.render(**context) for context in contexts]
+
+
+TEMPLATES = {email_type: EmailTemplate(email_type.value) for email_type in EmailType}
+
+
+def get_sendgrid_client() -> SendGridAPIClient:
+    """Return the SendGrid client shared by all sends, creating it on first use"""
+    global _sendgrid_client
+
+    if _sendgrid_client is None:
+        _sendgrid_client = SendGridAPIClient(settings.SENDGRID_SECRET)
+    return _sendgrid_client
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Return the thread pool the blocking SendGrid calls run in, creating it on first use.
+
+    At most EMAIL_MAX_WORKERS emails are sent at a time, the others wait for a free thread.
+    """
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.EMAIL_MAX_WORKERS, thread_name_prefix="sendgrid")
+    return _executor
+
+
+async def dispose() -> None:
+    """Send the queued emails and shut the thread pool down once sent, meant for the FastAPI lifespan"""
+    global _sendgrid_client, _executor
+
+    await email_queue.drain()
+    executor = _executor
+    _sendgrid_client, _executor = None, None
+
+    if executor is not None:
+        await asyncio.to_thread(executor.shutdown)
+
+
+def render_email(  # type: ignore
+    email_type: EmailType = EmailType.INVITE_TO_LCA,
+    html_body: str | None = None,
+    **kwargs,
+) -> str:
+    """Return `html_body`, or else the template of `email_type` with the kwargs inserted, see `EmailTemplate`"""
+    if html_body:
+        return html_body
+    return TEMPLATES[email_type].render(**kwargs)
+
+
 async def send_email(  # type: ignore
     recepient: str,
     email_type: EmailType = EmailType.INVITE_TO_LCA,
@@ -52,6 +151,9 @@ async def send_email(  # type: ignore
     """
     Send an email invitation to the LCA Platform using Sendgrid
 
+    The SendGrid client is synchronous, so the request runs in a thread of `get_executor()`
+    and doesn't block the event loop.
+
     Parameters
     ----------
     recepient: str
@@ -69,18 +171,7 @@ async def send_email(  # type: ignore
         TASK_COMMENT: {"task":"<>", "comment": "<>"}
 
     """
-    message_body = ""
-    if html_body:
-        message_body = html_body
-    else:
-        is_error = True
-        while is_error:
-            try:
-                message_body = email_type.value.format(**kwargs)
-                is_error = False
-            except KeyError as e:
-                for arg in e.args:
-                    kwargs[arg] = ""
+    message_body = render_email(email_type, html_body, **kwargs)
 
     message = Mail(
         from_email=settings.EMAIL_NOTIFICATION_FROM,
@@ -89,11 +180,131 @@ async def send_email(  # type: ignore
         html_content=message_body,
     )
     try:
-        sg = SendGridAPIClient(settings.SENDGRID_SECRET)
+        sg = get_sendgrid_client()
 
-        response = sg.send(message)
+        response = await asyncio.get_running_loop().run_in_executor(get_executor(), sg.send, message)
     except Exception as e:
         logger.error(e)
         response = e.body  # type: ignore
 
     return response
+
+
+@dataclass
+class QueuedEmail:
+    recipient: str
+    body: str
+    queued_at: float = field(default_factory=time.monotonic)
+
+
+class EmailQueue:
+    """
+    In-process queue of emails sent by a background worker, so callers don't wait for SendGrid.
+
+    The worker takes all emails queued so far and sends the ones with the same body in one request,
+    with a personalization per recipient and at most SENDGRID_MAX_PERSONALIZATIONS per request.
+    Failed requests are retried EMAIL_QUEUE_MAX_RETRIES times, backing off exponentially.
+    The worker is started by the first `put` on an event loop.
+    """
+
+    def __init__(self) -> None:
+        self._queue: asyncio.Queue[QueuedEmail] | None = None
+        self._worker: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def put(self, recipients: str | list[str], body: str) -> None:
+        loop = asyncio.get_running_loop()
+        if self._queue is None or self._loop is not loop:
+            self._queue = asyncio.Queue()
+            self._worker = None
+            self._loop = loop
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._work())
+
+        for recipient in [recipients] if isinstance(recipients, str) else recipients:
+            self._queue.put_nowait(QueuedEmail(recipient, body))
+        EMAIL_QUEUE_DEPTH.set(self._queue.qsize())
+
+    def __len__(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def drain(self) -> None:
+        """Wait until the queued emails are sent and stop the worker"""
+        worker, queue = self._worker, self._queue
+        if worker is None or queue is None or self._loop is not asyncio.get_running_loop():
+            return
+        if not worker.done():
+            await queue.join()
+            worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        self._worker = None
+
+    async def _work(self) -> None:
+        assert self._queue is not None
+        queue = self._queue
+        while True:
+            emails = [await queue.get()]
+            while not queue.empty():
+                emails.append(queue.get_nowait())
+            EMAIL_QUEUE_DEPTH.set(queue.qsize())
+
+            try:
+                by_body: dict[str, list[QueuedEmail]] = {}
+                for email in emails:
+                    by_body.setdefault(email.body, []).append(email)
+                for body, same_body in by_body.items():
+                    for index in range(0, len(same_body), SENDGRID_MAX_PERSONALIZATIONS):
+                        await self._send(body, same_body[index : index + SENDGRID_MAX_PERSONALIZATIONS])
+            except Exception:
+                logger.exception("Failed to send queued emails")
+            finally:
+                for _ in emails:
+                    queue.task_done()
+
+    async def _send(self, body: str, emails: list[QueuedEmail]) -> None:
+        message = Mail(
+            from_email=settings.EMAIL_NOTIFICATION_FROM,
+            to_emails=list(dict.fromkeys(email.recipient for email in emails)),
+            subject="LCA project",
+            html_content=body,
+            is_multiple=True,
+        )
+        loop = asyncio.get_running_loop()
+        for attempt in range(settings.EMAIL_QUEUE_MAX_RETRIES + 1):
+            try:
+                await loop.run_in_executor(get_executor(), get_sendgrid_client().send, message)
+                break
+            except Exception as e:
+                status_code = getattr(e, "status_code", None)
+                if attempt == settings.EMAIL_QUEUE_MAX_RETRIES or (
+                    status_code is not None and status_code not in RETRY_STATUS_CODES
+                ):
+                    logger.error(f"Failed to send email to {len(emails)} recipients: {e}")
+                    EMAILS_SENT.labels(result="failed").inc(len(emails))
+                    return
+                delay = settings.EMAIL_QUEUE_RETRY_BACKOFF * 2**attempt
+                logger.warning(f"Sending email failed with {e}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+        now = time.monotonic()
+        for email in emails:
+            EMAIL_QUEUE_LATENCY.observe(now - email.queued_at)
+        EMAILS_SENT.labels(result="sent").inc(len(emails))
+
+
+email_queue = EmailQueue()
+
+
+def enqueue_email(  # type: ignore
+    recipients: str | list[str],
+    email_type: EmailType = EmailType.INVITE_TO_LCA,
+    html_body: str | None = None,
+    **kwargs,
+) -> None:
+    """
+    Queue an email to one or more recipients and return at once, see `send_email` for the parameters.
+
+    Emails are sent by the worker of `email_queue`, recipients of the same email share SendGrid requests.
+    Call `dispose` on shutdown to send the emails still queued.
+    """
+    email_queue.put(recipients, render_email(email_type, html_body, **kwargs))
@@ -11,10 +11,12 @@ except (ImportError, ModuleNotFoundError):
 
 
 try:
-    from lcaplatform_config.connection import get_db
+    from lcaplatform_config.connection import get_lazy_db, get_lazy_read_db
 
-    async def get_context(session=Depends(get_db), user=Security(azure_scheme)):  # type: ignore
-        return {"session": session, "user": user}
+    async def get_context(  # type: ignore
+        session=Depends(get_lazy_db), read_session=Depends(get_lazy_read_db), user=Security(azure_scheme)
+    ):
+        return {"session": session, "read_session": read_session, "user": user}
 
 except (ImportError, ModuleNotFoundError, AttributeError):
 
@@ -1,23 +1,35 @@
+import asyncio
+import gzip
 import logging
+import os
 import time
+from collections import OrderedDict
+from collections.abc import Iterable, Sequence
+from functools import lru_cache
 
 from opentelemetry import trace
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry.instrumentation.logging import LoggingInstrumentor
 from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import ReadableSpan, Span, SpanProcessor, TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from opentelemetry.sdk.trace.sampling import Decision, ParentBasedTraceIdRatio, Sampler, SamplingResult
+from opentelemetry.trace import Link, SpanContext, SpanKind, StatusCode, TraceFlags, TraceState
+from opentelemetry.util.types import Attributes
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
 from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST, generate_latest
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
 from starlette.requests import Request
 from starlette.responses import Response
-from starlette.routing import Match
+from starlette.routing import BaseRoute, Match
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
-from starlette.types import ASGIApp
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-INFO = Gauge("fastapi_app_info", "FastAPI application information.", ["app_name"])
+from lcaplatform_config import config
+
+# In multiprocess mode every worker writes its own gauge values, the multiprocess_mode sets how they are aggregated
+INFO = Gauge("fastapi_app_info", "FastAPI application information.", ["app_name"], multiprocess_mode="livemax")
 REQUESTS = Counter(
     "fastapi_requests_total", "Total count of requests by method and path.", ["method", "path", "app_name"]
 )
@@ -40,6 +52,73 @@ REQUESTS_IN_PROGRESS = Gauge(
     "fastapi_requests_in_progress",
     "Gauge of requests by method and path currently being processed",
     ["method", "path", "app_name"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "sqlalchemy_pool_checked_out_connections",
+    "Gauge of connections currently checked out of the pool",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_OVERFLOW = Gauge(
+    "sqlalchemy_pool_overflow_connections",
+    "Gauge of overflow connections in use above the pool size",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_CHECKOUT_WAIT_TIME = Histogram(
+    "sqlalchemy_pool_checkout_wait_seconds",
+    "Histogram of time spent waiting for a pooled connection (in seconds)",
+    ["pool"],
+)
+DB_CONNECTION_AGE = Histogram(
+    "sqlalchemy_pool_connection_age_seconds",
+    "Histogram of the age of pooled connections at checkout (in seconds)",
+    ["pool"],
+    buckets=(1, 10, 60, 300, 900, 1800, 3600, 4 * 3600, 12 * 3600, 24 * 3600, float("inf")),
+)
+DB_STATEMENT_DURATION = Histogram(
+    "sqlalchemy_statement_duration_seconds",
+    "Histogram of statement execution time by operation (in seconds)",
+    ["pool", "operation"],
+)
+CACHE_HITS = Counter("cache_hits_total", "Total count of in-process cache hits by cache", ["cache"])
+CACHE_MISSES = Counter("cache_misses_total", "Total count of in-process cache misses by cache", ["cache"])
+CACHE_REFRESHES = Counter(
+    "cache_refreshes_total", "Total count of entries refreshed ahead of expiry by cache and result", ["cache", "result"]
+)
+CACHE_REFRESH_DURATION = Histogram(
+    "cache_refresh_duration_seconds", "Histogram of refresh-ahead run duration by cache (in seconds)", ["cache"]
+)
+EMAIL_QUEUE_DEPTH = Gauge(
+    "email_queue_depth", "Emails waiting in the in-process email queue", multiprocess_mode="livesum"
+)
+EMAIL_QUEUE_LATENCY = Histogram(
+    "email_queue_latency_seconds",
+    "Histogram of time from queueing an email until it was sent (in seconds)",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")),
+)
+EMAILS_SENT = Counter("emails_sent_total", "Total count of queued emails by result", ["result"])
+GRAPHQL_PHASE_DURATION = Histogram(
+    "graphql_phase_duration_seconds",
+    "Histogram of GraphQL request phase duration by phase (in seconds)",
+    ["phase"],
+)
+GRAPHQL_RESOLVER_DURATION = Histogram(
+    "graphql_resolver_duration_seconds",
+    "Histogram of GraphQL resolver duration by parent type and field (in seconds)",
+    ["resolver"],
+)
+GRAPHQL_N_PLUS_ONE = Counter(
+    "graphql_n_plus_one_total",
+    "Total count of GraphQL requests calling a resolver more often than the N+1 threshold, by resolver",
+    ["resolver"],
+)
+CACHE_REFRESH_TRACKED = Gauge(
+    "cache_refresh_tracked_entries",
+    "Entries tracked for refresh-ahead by cache",
+    ["cache"],
+    multiprocess_mode="livesum",
 )
 
 
@@ -53,43 +132,106 @@ class EndpointFilter(logging.Filter):
         return record.getMessage().find("GET /metrics") == -1
 
 
-class PrometheusMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app: ASGIApp, app_name: str = "fastapi-app") -> None:
-        super().__init__(app)
+class PrometheusMiddleware:
+    """
+    Records the request metrics of the app's routes.
+
+    A pure ASGI middleware: the response is passed through as it is and only `send` is wrapped
+    to read the status code, so streaming responses and background tasks aren't affected.
+    The processing time covers the whole response, including a streamed body.
+
+    The route template of a path is resolved once per method and path and kept in a bounded LRU
+    of `route_cache_size` entries. The cache is cleared when routes are added or removed or the app's
+    route list is replaced. A route replaced in place isn't noticed, as that would mean comparing every
+    route on each request, so call `invalidate_routes` after doing so. The metric children are bound
+    once per method, route template and status code. To bound the label values, methods outside
+    `methods` are recorded as "other" and status codes outside `status_classes`, e.g. ["2xx", "5xx"],
+    as their class.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        app_name: str = "fastapi-app",
+        methods: Iterable[str] | None = None,
+        status_classes: Iterable[str] | None = None,
+        route_cache_size: int = 1024,
+    ) -> None:
+        self.app = app
         self.app_name = app_name
+        self.methods = frozenset(method.upper() for method in methods) if methods is not None else None
+        self.status_classes = frozenset(str(status)[0] for status in status_classes) if status_classes else None
+        self.route_cache_size = route_cache_size
+        self._routes: list[BaseRoute] | None = None
+        self._routes_count = 0
+        self._paths: OrderedDict[tuple[str, str], tuple[str, bool]] = OrderedDict()
+        self._children: dict[tuple[str, str], tuple[Counter, Gauge, Histogram]] = {}
+        self._responses: dict[tuple[str, str, int], Counter] = {}
         INFO.labels(app_name=self.app_name).inc()
 
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        method = request.method
-        path, is_handled_path = self.get_path(request)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path, is_handled_path = self.resolve_path(scope)
 
         if not is_handled_path:
-            return await call_next(request)
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"] if self.methods is None or scope["method"] in self.methods else "other"
+        requests, requests_in_progress, requests_processing_time = self._get_children(method, path)
+        status_code = HTTP_500_INTERNAL_SERVER_ERROR
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
 
-        REQUESTS_IN_PROGRESS.labels(method=method, path=path, app_name=self.app_name).inc()
-        REQUESTS.labels(method=method, path=path, app_name=self.app_name).inc()
+        requests_in_progress.inc()
+        requests.inc()
         before_time = time.perf_counter()
         try:
-            response = await call_next(request)
+            await self.app(scope, receive, send_wrapper)
         except BaseException as e:
             status_code = HTTP_500_INTERNAL_SERVER_ERROR
             EXCEPTIONS.labels(method=method, path=path, exception_type=type(e).__name__, app_name=self.app_name).inc()
-            raise e from None
+            raise
         else:
-            status_code = response.status_code
             after_time = time.perf_counter()
             # retrieve trace id for exemplar
             span = trace.get_current_span()
             trace_id = trace.format_trace_id(span.get_span_context().trace_id)
 
-            REQUESTS_PROCESSING_TIME.labels(method=method, path=path, app_name=self.app_name).observe(
-                after_time - before_time, exemplar={"TraceID": trace_id}
-            )
+            requests_processing_time.observe(after_time - before_time, exemplar={"TraceID": trace_id})
         finally:
-            RESPONSES.labels(method=method, path=path, status_code=status_code, app_name=self.app_name).inc()
-            REQUESTS_IN_PROGRESS.labels(method=method, path=path, app_name=self.app_name).dec()
+            self._get_responses(method, path, status_code).inc()
+            requests_in_progress.dec()
+
+    def resolve_path(self, scope: Scope) -> tuple[str, bool]:
+        """Return the route template of the request and whether a route fully matches it, cached from `get_path`"""
+        routes: list[BaseRoute] = scope["app"].routes
+        if routes is not self._routes or len(routes) != self._routes_count:
+            self.invalidate_routes()
+            self._routes = routes
+            self._routes_count = len(routes)
+
+        key = (scope["method"], scope["path"])
+        resolved = self._paths.get(key)
+        if resolved is not None:
+            self._paths.move_to_end(key)
+            return resolved
 
-        return response
+        resolved = self._paths[key] = self.get_path(Request(scope))
+        if len(self._paths) > self.route_cache_size:
+            self._paths.popitem(last=False)
+        return resolved
+
+    def invalidate_routes(self) -> None:
+        """Forget the resolved route templates, e.g. after replacing one of the app's routes in place"""
+        self._paths.clear()
 
     @staticmethod
     def get_path(request: Request) -> tuple[str, bool]:
@@ -100,23 +242,305 @@ class PrometheusMiddleware(BaseHTTPMiddleware):
 
         return request.url.path, False
 
+    def _get_children(self, method: str, path: str) -> tuple[Counter, Gauge, Histogram]:
+        children = self._children.get((method, path))
+        if children is None:
+            labels = {"method": method, "path": path, "app_name": self.app_name}
+            children = self._children[(method, path)] = (
+                REQUESTS.labels(**labels),
+                REQUESTS_IN_PROGRESS.labels(**labels),
+                REQUESTS_PROCESSING_TIME.labels(**labels),
+            )
+        return children
+
+    def _get_responses(self, method: str, path: str, status_code: int) -> Counter:
+        responses = self._responses.get((method, path, status_code))
+        if responses is None:
+            status: int | str = status_code
+            if self.status_classes is not None and str(status_code)[0] not in self.status_classes:
+                status = f"{str(status_code)[0]}xx"
+            responses = self._responses[(method, path, status_code)] = RESPONSES.labels(
+                method=method, path=path, status_code=status, app_name=self.app_name
+            )
+        return responses
+
+
+def multiprocess_dir() -> str | None:
+    """
+    The directory of the metric files shared by the worker processes, if multiprocess mode is on.
+
+    Multiprocess mode is turned on by setting PROMETHEUS_MULTIPROC_DIR before prometheus_client is imported,
+    e.g. in the environment of gunicorn or uvicorn with several workers.
+    """
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+
+def get_registry() -> CollectorRegistry:
+    """Registry with the metrics of all worker processes in multiprocess mode, else the default registry"""
+    if multiprocess_dir() is None:
+        return REGISTRY
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def clear_multiprocess_dir() -> None:
+    """
+    Remove the metric files left by a previous run.
+
+    Call it once before the workers start, e.g. in gunicorn's `on_starting` hook, as counters of the
+    previous run's processes would otherwise still be added up.
+    """
+    path = multiprocess_dir()
+    if path is None:
+        return
+
+    for name in os.listdir(path):
+        if name.endswith(".db"):
+            os.remove(os.path.join(path, name))
+
+
+def mark_worker_dead(pid: int) -> None:
+    """
+    Remove the live gauge values of a worker process that has exited.
+
+    Call it from gunicorn's `child_exit` hook. Uvicorn workers call it for themselves through `dispose`.
+    """
+    if multiprocess_dir() is not None:
+        multiprocess.mark_process_dead(pid)
+
+
+async def dispose() -> None:
+    """Remove this worker's live gauge values in multiprocess mode, meant for the FastAPI lifespan"""
+    mark_worker_dead(os.getpid())
+
+
+@lru_cache(maxsize=1)
+def get_metrics_settings() -> config.MetricsSettings:
+    """
+    The settings of the app, or the metrics settings from the environment for apps without `core.config`.
+
+    Read on first use, so importing the module doesn't need the app's settings.
+    """
+    try:
+        from core.config import settings
+    except (ImportError, ModuleNotFoundError):
+        return config.MetricsSettings()
+    return settings  # type: ignore[no-any-return]
+
+
+class MetricsExposition:
+    """
+    Serves the OpenMetrics exposition of `get_registry` from `endpoint`.
+
+    The exposition is generated in a worker thread, so a slow collection doesn't stall the event loop,
+    and reused for `interval` seconds. Concurrent scrapes wait for the same generation.
+    With `compress` the exposition is gzip-compressed once per generation for scrapers accepting it.
+    The options not given are taken from METRICS_CACHE_INTERVAL and METRICS_GZIP on first use.
+    """
+
+    def __init__(self, interval: float | None = None, compress: bool | None = None) -> None:
+        self._interval = interval
+        self._compress = compress
+        self._body: bytes | None = None
+        self._compressed: asyncio.Task[bytes] | None = None
+        self._generated_at = 0.0
+        self._pending: asyncio.Task[None] | None = None
+
+    @property
+    def interval(self) -> float:
+        if self._interval is None:
+            self._interval = get_metrics_settings().METRICS_CACHE_INTERVAL
+        return self._interval
+
+    @property
+    def compress(self) -> bool:
+        if self._compress is None:
+            self._compress = get_metrics_settings().METRICS_GZIP
+        return self._compress
+
+    async def endpoint(self, request: Request) -> Response:
+        headers = {"Content-Type": CONTENT_TYPE_LATEST, "Vary": "Accept-Encoding"}
+        if self.compress and "gzip" in request.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            return Response(await self.get_body(compressed=True), headers=headers)
+        return Response(await self.get_body(), headers=headers)
+
+    async def get_body(self, compressed: bool = False) -> bytes:
+        """Return the exposition, generated again when it is older than the interval"""
+        if self._body is None or time.monotonic() - self._generated_at >= self.interval:
+            await self._generate()
+        body = self._body
+        assert body is not None
+        if not compressed:
+            return body
+
+        compressing = self._compressed
+        if compressing is None or compressing.get_loop() is not asyncio.get_running_loop():
+            # concurrent scrapes share the compression, which is cleared with the next generation
+            compressing = self._compressed = asyncio.create_task(asyncio.to_thread(gzip.compress, body))
+        return await asyncio.shield(compressing)
+
+    async def _generate(self) -> None:
+        pending = self._pending
+        if pending is None or pending.get_loop() is not asyncio.get_running_loop():
+            pending = self._pending = asyncio.create_task(self._collect())
+        # a cancelled scrape doesn't cancel the generation the others wait for
+        await asyncio.shield(pending)
+
+    async def _collect(self) -> None:
+        try:
+            body = await asyncio.to_thread(lambda: generate_latest(get_registry()))
+            self._body, self._compressed, self._generated_at = body, None, time.monotonic()
+        finally:
+            self._pending = None
+
+
+metrics = MetricsExposition().endpoint
+
+
+class RecordingSampler(Sampler):
+    """Sampler recording the spans its `root` sampler drops, for `TailSpanProcessor` to look at"""
+
+    def __init__(self, root: Sampler) -> None:
+        self.root = root
+
+    def should_sample(
+        self,
+        parent_context: Context | None,
+        trace_id: int,
+        name: str,
+        kind: SpanKind | None = None,
+        attributes: Attributes = None,
+        links: Sequence[Link] | None = None,
+        trace_state: TraceState | None = None,
+    ) -> SamplingResult:
+        result = self.root.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+        if result.decision is Decision.DROP:
+            return SamplingResult(Decision.RECORD_ONLY, result.attributes, result.trace_state)
+        return result
+
+    def get_description(self) -> str:
+        return f"RecordingSampler{{{self.root.get_description()}}}"
+
+
+class TailSpanProcessor(SpanProcessor):
+    """
+    Span processor passing the sampled spans to `processor`, and the spans the sampler dropped if they failed or were slow.
+
+    Use it with a sampler recording the dropped spans, `RecordingSampler`. A kept span is passed on as a sampled copy.
+    Only the failed or slow span itself is kept, its sampled-out children and parent are not.
+    """
+
+    def __init__(
+        self, processor: SpanProcessor, keep_errors: bool = False, slow_threshold: float | None = None
+    ) -> None:
+        self.processor = processor
+        self.keep_errors = keep_errors
+        self.slow_threshold_ns = int(slow_threshold * 1e9) if slow_threshold is not None else None
+
+    def on_start(self, span: Span, parent_context: Context | None = None) -> None:
+        self.processor.on_start(span, parent_context)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        if span.context is None or span.context.trace_flags.sampled:
+            self.processor.on_end(span)
+        elif self.should_keep(span):
+            self.processor.on_end(self.as_sampled(span))
+
+    def shutdown(self) -> None:
+        self.processor.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.processor.force_flush(timeout_millis)
+
+    def should_keep(self, span: ReadableSpan) -> bool:
+        if self.keep_errors and span.status.status_code is StatusCode.ERROR:
+            return True
+        if self.slow_threshold_ns is None or span.start_time is None or span.end_time is None:
+            return False
+        return span.end_time - span.start_time >= self.slow_threshold_ns
+
+    @staticmethod
+    def as_sampled(span: ReadableSpan) -> ReadableSpan:
+        context = span.context
+        assert context is not None
+        return ReadableSpan(
+            name=span.name,
+            context=SpanContext(
+                context.trace_id,
+                context.span_id,
+                context.is_remote,
+                TraceFlags(context.trace_flags | TraceFlags.SAMPLED),
+                context.trace_state,
+            ),
+            parent=span.parent,
+            resource=span.resource,
+            attributes=span.attributes,
+            events=span.events,
+            links=span.links,
+            kind=span.kind,
+            status=span.status,
+            start_time=span.start_time,
+            end_time=span.end_time,
+            instrumentation_scope=span.instrumentation_scope,
+        )
+
 
-def metrics(request: Request) -> Response:
-    return Response(generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+def setting_otlp(
+    app: ASGIApp,
+    app_name: str,
+    endpoint: str,
+    log_correlation: bool = True,
+    sample_ratio: float | None = None,
+    keep_errors: bool | None = None,
+    slow_threshold: float | None = None,
+    max_queue_size: int | None = None,
+    max_export_batch_size: int | None = None,
+    schedule_delay_millis: int | None = None,
+    excluded_urls: str | None = None,
+) -> None:
+    """
+    Set up tracing of the app, exported to the OTLP gRPC `endpoint`.
 
+    The options not given are taken from the OTLP_* settings. Traces are sampled with `sample_ratio`
+    unless the caller's trace was sampled. With `keep_errors` and `slow_threshold` (in seconds), spans
+    that failed or took longer are exported even when they were sampled out, see `TailSpanProcessor`.
+    Every span is then recorded, so only the export is saved, not the cost of creating the spans.
+    `excluded_urls` is a comma-separated list of regular expressions of URLs not traced.
+    """
+    settings = get_metrics_settings()
+    sample_ratio = settings.OTLP_SAMPLE_RATIO if sample_ratio is None else sample_ratio
+    keep_errors = settings.OTLP_KEEP_ERRORS if keep_errors is None else keep_errors
+    slow_threshold = settings.OTLP_SLOW_SPAN_THRESHOLD if slow_threshold is None else slow_threshold
+    excluded_urls = settings.OTLP_EXCLUDED_URLS if excluded_urls is None else excluded_urls
 
-def setting_otlp(app: ASGIApp, app_name: str, endpoint: str, log_correlation: bool = True) -> None:
     # Setting OpenTelemetry
     # set the service name to show in traces
     resource = Resource.create(attributes={"service.name": app_name, "compose_service": app_name})
 
     # set the tracer provider
-    tracer = TracerProvider(resource=resource)
+    sampler: Sampler = ParentBasedTraceIdRatio(sample_ratio)
+    if sample_ratio < 1 and (keep_errors or slow_threshold is not None):
+        # record the spans the ratio drops, for the processor to keep the failed and slow ones
+        sampler = RecordingSampler(sampler)
+    tracer = TracerProvider(resource=resource, sampler=sampler)
     trace.set_tracer_provider(tracer)
 
-    tracer.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint, insecure=True)))
+    batch_processor = BatchSpanProcessor(
+        OTLPSpanExporter(endpoint=endpoint, insecure=True),
+        max_queue_size=settings.OTLP_MAX_QUEUE_SIZE if max_queue_size is None else max_queue_size,
+        max_export_batch_size=(
+            settings.OTLP_MAX_EXPORT_BATCH_SIZE if max_export_batch_size is None else max_export_batch_size
+        ),
+        schedule_delay_millis=settings.OTLP_SCHEDULE_DELAY if schedule_delay_millis is None else schedule_delay_millis,
+    )
+    tracer.add_span_processor(
+        TailSpanProcessor(batch_processor, keep_errors=keep_errors, slow_threshold=slow_threshold)
+    )
 
     if log_correlation:
         LoggingInstrumentor().instrument(set_logging_format=True)
 
-    FastAPIInstrumentor.instrument_app(app, tracer_provider=tracer)  # type: ignore
+    FastAPIInstrumentor.instrument_app(app, tracer_provider=tracer, excluded_urls=excluded_urls)  # type: ignore
@@ -1,9 +1,22 @@
-from fastapi import Request
+import random
+import time
+from collections.abc import Awaitable, Callable, Iterator
+from functools import lru_cache
+from inspect import isawaitable
+from typing import Any
+
+from fastapi import Request, Response
+from graphql import FieldNode, GraphQLError, GraphQLResolveInfo, OperationDefinitionNode, parse
+from opentelemetry import trace
+from strawberry.extensions import SchemaExtension
+from strawberry.extensions.tracing.utils import should_skip_tracing
 from strawberry.fastapi import GraphQLRouter
-from strawberry.http import GraphQLHTTPResponse
-from strawberry.types import ExecutionResult
+from strawberry.http import GraphQLHTTPResponse, GraphQLRequestData
+from strawberry.http.async_base_view import AsyncHTTPRequestAdapter
+from strawberry.types import ExecutionContext, ExecutionResult
 from opentelemetry.propagate import inject
 from lcaplatform_config.logging import config_logging
+from lcaplatform_config.monitoring import GRAPHQL_N_PLUS_ONE, GRAPHQL_PHASE_DURATION, GRAPHQL_RESOLVER_DURATION
 
 try:
     from core.config import settings
@@ -15,12 +28,53 @@ except (ImportError, ModuleNotFoundError):
 logger = config_logging(__name__)
 
 
+@lru_cache(maxsize=256)
+def parse_operation(query: str, operation_name: str | None = None) -> tuple[str | None, str]:
+    """
+    Return the name and the root field of the executed operation of a query.
+
+    The operation is the one named `operation_name`, or the first one. Parsed once per query and operation name.
+    """
+    try:
+        document = parse(query, no_location=True)
+    except GraphQLError:
+        return operation_name, ""
+
+    for definition in document.definitions:
+        if not isinstance(definition, OperationDefinitionNode):
+            continue
+        name = definition.name.value if definition.name else None
+        if operation_name is None or name == operation_name:
+            fields = [
+                selection for selection in definition.selection_set.selections if isinstance(selection, FieldNode)
+            ]
+            return name, fields[0].name.value if fields else ""
+    return operation_name, ""
+
+
 class LCAGraphQLRouter(GraphQLRouter):
+    async def execute_single(
+        self,
+        request: Request,
+        request_adapter: AsyncHTTPRequestAdapter,
+        sub_response: Response,
+        context: Any,
+        root_value: Any,
+        request_data: GraphQLRequestData,
+    ) -> ExecutionResult:
+        """Keep the parsed request data of each operation, also of batched ones, for `process_result`"""
+        result = await super().execute_single(request, request_adapter, sub_response, context, root_value, request_data)
+        if not hasattr(request.state, "graphql_requests"):
+            request.state.graphql_requests = {}
+        request.state.graphql_requests[id(result)] = request_data
+        return result
+
     async def process_result(self, request: Request, result: ExecutionResult) -> GraphQLHTTPResponse:
         """
         Override method of parent class to log the GraphQL path that is called.
 
-        Cleans the raw query string to obtain the GraphQL path.
+        The GraphQL path is the root field of the operation, taken from the request data Strawberry
+        already parsed, so the request body isn't decoded again.
 
         Args:
             request (Request): Request body object.
@@ -29,11 +83,13 @@ class LCAGraphQLRouter(GraphQLRouter):
         Returns:
             GraphQLHTTPResponse: HTTP response object.
         """
-        parsed_request = await request.json()
-        query = parsed_request["query"]
-        path = query.split("{")[1].replace("{", "").replace("query", "").strip().split("(")[0]
+        request_data = getattr(request.state, "graphql_requests", {}).pop(id(result), None)
+        path, variables = "", None
+        if request_data is not None:
+            variables = request_data.variables
+            if request_data.query:
+                _, path = parse_operation(request_data.query, request_data.operation_name)
 
-        variables = parsed_request.get("variables", "")
         user = getattr(request.state, "user", "")
         user_name = ""
         if user:
@@ -55,3 +111,110 @@ class LCAGraphQLRouter(GraphQLRouter):
             logger.info(f'User: "{user_name}", GraphQL path: "{path}", vars: "{variables}"')
 
         return await super().process_result(request, result)
+
+
+class ProfilingExtension(SchemaExtension):
+    """
+    Strawberry extension timing the phases and resolvers of a sample of the GraphQL requests.
+
+    Opt in by adding it to the schema, `strawberry.Schema(query, extensions=[ProfilingExtension])`.
+    For a share of `sample_rate` requests, GRAPHQL_PROFILING_SAMPLE_RATE by default, it records
+    the parse, validation, execution and whole operation durations and the durations of the custom
+    resolvers as Prometheus histograms and as attributes of the current span. Resolvers called more than
+    `n_plus_one_threshold` times in a request, GRAPHQL_N_PLUS_ONE_THRESHOLD by default, are counted
+    and logged as possible N+1 queries.
+    """
+
+    def __init__(
+        self,
+        *,
+        execution_context: ExecutionContext | None = None,
+        sample_rate: float | None = None,
+        n_plus_one_threshold: int | None = None,
+    ) -> None:
+        self.sample_rate = settings.GRAPHQL_PROFILING_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.n_plus_one_threshold = (
+            settings.GRAPHQL_N_PLUS_ONE_THRESHOLD if n_plus_one_threshold is None else n_plus_one_threshold
+        )
+        self.sampled = False
+        self.phases: dict[str, float] = {}
+        self.resolvers: dict[str, list[float]] = {}  # calls and seconds by resolver
+        if execution_context:
+            self.execution_context = execution_context
+
+    def on_operation(self) -> Iterator[None]:
+        self.sampled = random.random() < self.sample_rate
+        yield from self._timed("operation")
+        if self.sampled:
+            self._report()
+
+    def on_parse(self) -> Iterator[None]:
+        yield from self._timed("parse")
+
+    def on_validate(self) -> Iterator[None]:
+        yield from self._timed("validation")
+
+    def on_execute(self) -> Iterator[None]:
+        yield from self._timed("execution")
+
+    def resolve(self, _next: Callable, root: Any, info: GraphQLResolveInfo, *args: str, **kwargs: Any) -> Any:
+        if not self.sampled or should_skip_tracing(_next, info):
+            return _next(root, info, *args, **kwargs)
+
+        name = f"{info.parent_type.name}.{info.field_name}"
+        start = time.perf_counter()
+        result = _next(root, info, *args, **kwargs)
+        if isawaitable(result):
+            return self._await_resolver(name, start, result)
+        self._record_resolver(name, start)
+        return result
+
+    def _timed(self, phase: str) -> Iterator[None]:
+        if not self.sampled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = time.perf_counter() - start
+
+    async def _await_resolver(self, name: str, start: float, result: Awaitable) -> Any:
+        try:
+            return await result
+        finally:
+            self._record_resolver(name, start)
+
+    def _record_resolver(self, name: str, start: float) -> None:
+        elapsed = time.perf_counter() - start
+        GRAPHQL_RESOLVER_DURATION.labels(resolver=name).observe(elapsed)
+        totals = self.resolvers.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += elapsed
+
+    def _report(self) -> None:
+        operation_name = self.execution_context.operation_name or ""
+        for phase, seconds in self.phases.items():
+            GRAPHQL_PHASE_DURATION.labels(phase=phase).observe(seconds)
+
+        n_plus_one = [name for name, (calls, _) in self.resolvers.items() if calls > self.n_plus_one_threshold]
+        for name in n_plus_one:
+            GRAPHQL_N_PLUS_ONE.labels(resolver=name).inc()
+            logger.warning(
+                f'GraphQL operation: "{operation_name}", resolver "{name}" was called '
+                f"{int(self.resolvers[name][0])} times, possibly an N+1 query"
+            )
+
+        span = trace.get_current_span()
+        if not span.is_recording():
+            return
+
+        span.set_attribute("graphql.operation.name", operation_name)
+        for phase, seconds in self.phases.items():
+            span.set_attribute(f"graphql.{phase}.duration", seconds)
+        for name, (calls, seconds) in self.resolvers.items():
+            span.set_attribute(f"graphql.resolver.{name}.calls", int(calls))
+            span.set_attribute(f"graphql.resolver.{name}.duration", seconds)
+        if n_plus_one:
+            span.set_attribute("graphql.n_plus_one", n_plus_one)
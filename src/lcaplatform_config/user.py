@@ -1,15 +1,33 @@
+import asyncio
+import datetime
+import functools
+import json
 import logging
 import re
+from typing import Any
+from urllib.parse import quote
 
+import httpx
 from aiocache import Cache
+from aiocache.serializers import BaseSerializer
 from azure.identity.aio import ClientSecretCredential
+from kiota_abstractions.api_error import APIError
 from kiota_abstractions.base_request_configuration import RequestConfiguration
-from msgraph import GraphServiceClient
+from kiota_abstractions.method import Method
+from kiota_abstractions.request_information import RequestInformation
+from kiota_authentication_azure.azure_identity_authentication_provider import AzureIdentityAuthenticationProvider
+from kiota_http.middleware.options import RetryHandlerOption
+from kiota_serialization_json.json_parse_node_factory import JsonParseNodeFactory
+from kiota_serialization_json.json_serialization_writer import JsonSerializationWriter
+from msgraph import GraphRequestAdapter, GraphServiceClient
 from msgraph.generated.models.invitation import Invitation
+from msgraph.generated.models.user import User
 from msgraph.generated.users.item.user_item_request_builder import UserItemRequestBuilder
+from msgraph_core import GraphClientFactory
 from requests import Response  # type: ignore
 
 from lcaplatform_config import exceptions
+from lcaplatform_config.cache import RefreshAhead, TieredCache, single_flight
 
 try:
     from core.config import settings
@@ -18,39 +36,324 @@ except (ImportError, ModuleNotFoundError):
 
     settings = config.Settings()
 
-cache = Cache()
+
+class UserSerializer(BaseSerializer):
+    """
+    Compact JSON for the shared user cache.
+
+    msgraph models can't be pickled, so users are written with the SDK's own JSON serialization,
+    which leaves out unset fields, and dates as ISO strings.
+    """
+
+    def dumps(self, value: Any) -> str:
+        return json.dumps(value, default=self._encode, separators=(",", ":"))
+
+    def loads(self, value: str | bytes | None) -> Any:
+        if value is None:
+            return None
+        return json.loads(value, object_hook=self._decode)
+
+    @staticmethod
+    def _encode(value: Any) -> dict[str, Any]:
+        if isinstance(value, User):
+            writer = JsonSerializationWriter()
+            writer.write_object_value(None, value)
+            return {"__user__": json.loads(writer.get_serialized_content())}
+        if isinstance(value, datetime.datetime):
+            return {"__datetime__": value.isoformat()}
+        if isinstance(value, datetime.date):
+            return {"__date__": value.isoformat()}
+        raise TypeError(f"Can't cache {type(value).__name__} objects")
+
+    @staticmethod
+    def _decode(value: dict[str, Any]) -> Any:
+        if "__user__" in value:
+            content = json.dumps(value["__user__"]).encode()
+            return JsonParseNodeFactory().get_root_parse_node("application/json", content).get_object_value(User)
+        if "__datetime__" in value:
+            return datetime.datetime.fromisoformat(value["__datetime__"])
+        if "__date__" in value:
+            return datetime.date.fromisoformat(value["__date__"])
+        return value
+
+
+def create_user_cache() -> TieredCache:
+    """Create the user cache configured by the USER_CACHE_* and *_CACHE_TTL settings"""
+    backend = None
+    if settings.USER_CACHE_URL:
+        backend = Cache.from_url(settings.USER_CACHE_URL)
+        backend.serializer = UserSerializer()
+    return TieredCache(
+        "azure_users",
+        maxsize=settings.USER_CACHE_MAX_SIZE,
+        backend=backend,
+        ttls={"azure_users": settings.AZURE_USERS_CACHE_TTL, "azure_emails": settings.AZURE_EMAILS_CACHE_TTL},
+        local_ttl=settings.USER_CACHE_LOCAL_TTL,
+    )
+
+
+cache = create_user_cache()
+_credentials: ClientSecretCredential | None = None
+_graph_client: GraphServiceClient | None = None
+_http_client: httpx.AsyncClient | None = None
+_graph_loop: asyncio.AbstractEventLoop | None = None
+_closing: set[asyncio.Task] = set()
+_refresh_tasks: list[asyncio.Task] = []
 
 logger = logging.getLogger(__name__)
 
+# throttled or temporarily unavailable
+RETRY_STATUS_CODES = {429, 503, 504}
+# most requests Graph accepts in one JSON $batch
+GRAPH_BATCH_LIMIT = 20
+USER_FIELDS = ["id", "displayName", "mail", "userPrincipalName", "companyName", "signInActivity"]
+# `with_retries` retries throttled requests itself, releasing the semaphore while waiting,
+# so the retry handler of the Graph client's middleware is turned off for those requests
+NO_CLIENT_RETRIES = RetryHandlerOption(max_retries=0, should_retry=False)
+
 
 def get_credentials() -> ClientSecretCredential:
-    return ClientSecretCredential(settings.AAD_TENANT_ID, settings.AAD_APP_CLIENT_ID, settings.AAD_GRAPH_SECRET)
+    """
+    Return the credential shared by all Graph calls, creating it on first use.
+
+    The credential caches its access token until shortly before it expires, so reusing it saves a token request per call.
+    """
+    global _credentials
+
+    if _credentials is None:
+        _credentials = ClientSecretCredential(
+            settings.AAD_TENANT_ID, settings.AAD_APP_CLIENT_ID, settings.AAD_GRAPH_SECRET
+        )
+    return _credentials
+
+
+def get_graph_client() -> GraphServiceClient:
+    """
+    Return the Graph client shared by all calls, creating it on first use.
+
+    Its connection pool belongs to the running event loop, so a new client is created when the loop changes,
+    and the previous client and credential are closed.
+    """
+    global _credentials, _graph_client, _http_client, _graph_loop
+
+    loop = asyncio.get_running_loop()
+    if _graph_client is None or _graph_loop is not loop:
+        if _graph_loop is not loop:
+            if _http_client is not None or _credentials is not None:
+                task = loop.create_task(close_graph_client(_http_client, _credentials))
+                _closing.add(task)
+                task.add_done_callback(_closing.discard)
+            _credentials = None
+        scopes = ["https://graph.microsoft.com/.default"]
+        # the client is kept to be closed, it has the middleware GraphServiceClient would set up itself
+        _http_client = GraphClientFactory.create_with_default_middleware()
+        auth_provider = AzureIdentityAuthenticationProvider(get_credentials(), scopes=scopes)
+        _graph_client = GraphServiceClient(request_adapter=GraphRequestAdapter(auth_provider, client=_http_client))
+        _graph_loop = loop
+    return _graph_client
+
+
+async def close_graph_client(http_client: httpx.AsyncClient | None, credentials: ClientSecretCredential | None) -> None:
+    """Close a Graph client's connections and its credential, logging rather than raising failures"""
+    closing = []
+    if http_client is not None:
+        closing.append(http_client.aclose())
+    if credentials is not None:
+        closing.append(credentials.close())
+    for result in await asyncio.gather(*closing, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to close the Graph client: {result}")
+
+
+async def startup() -> GraphServiceClient:
+    """
+    Create the shared Graph client and start refreshing hot cached users when USER_REFRESH_AHEAD is set.
+
+    Meant to be called from the FastAPI lifespan together with `dispose`.
+    """
+    if settings.USER_REFRESH_AHEAD and not _refresh_tasks:
+        for refresher in (users_refresher, emails_refresher):
+            _refresh_tasks.append(asyncio.create_task(refresher.run(settings.USER_REFRESH_INTERVAL)))
+    return get_graph_client()
+
+
+async def dispose() -> None:
+    """Stop refreshing cached users and close the shared Graph client, credential and user cache connections"""
+    global _credentials, _graph_client, _http_client, _graph_loop
+
+    for task in _refresh_tasks:
+        task.cancel()
+    await asyncio.gather(*_refresh_tasks, return_exceptions=True)
+    _refresh_tasks.clear()
+
+    credentials, http_client = _credentials, _http_client
+    _credentials, _graph_client, _http_client, _graph_loop = None, None, None, None
+
+    if http_client is not None:
+        await http_client.aclose()
+    if credentials is not None:
+        await credentials.close()
+    await cache.close()
+
+
+def retry_delay(error: APIError, attempt: int) -> float:
+    """Seconds to wait before retrying, taken from the Retry-After header or else backing off exponentially"""
+    headers = {key.lower(): value for key, value in (error.response_headers or {}).items()}
+    retry_after = headers.get("retry-after")
+    if retry_after and not isinstance(retry_after, str):
+        retry_after = next(iter(retry_after), None)
+    try:
+        return float(retry_after)  # type: ignore
+    except (TypeError, ValueError):
+        return float(settings.GRAPH_RETRY_BACKOFF * 2**attempt)
+
+
+async def with_retries(semaphore: asyncio.Semaphore, request: Any) -> Any:
+    """
+    Await `request()` holding the semaphore, retrying throttled requests up to GRAPH_MAX_RETRIES times.
+    A request Graph asks to wait longer than GRAPH_MAX_RETRY_DELAY for isn't retried.
+
+    The semaphore is released while waiting so other requests can go on. The request has to turn off
+    the Graph client's own retries with NO_CLIENT_RETRIES, or both would retry.
+    """
+    for attempt in range(settings.GRAPH_MAX_RETRIES + 1):
+        async with semaphore:
+            try:
+                return await request()
+            except APIError as e:
+                if e.response_status_code not in RETRY_STATUS_CODES or attempt == settings.GRAPH_MAX_RETRIES:
+                    raise
+                delay = retry_delay(e, attempt)
+                if delay > settings.GRAPH_MAX_RETRY_DELAY:
+                    raise
+                logger.warning(f"Graph API responded with {e.response_status_code}, retrying in {delay}s")
+        await asyncio.sleep(delay)
+
+
+def user_to_dict(user: User) -> dict[str, Any]:
+    email = user.mail
+    # some accounts have null emails
+    if not email:
+        if re.match(
+            r"^([a-zA-Z0-9_\-\.]+)@([a-zA-Z0-9_\-\.]+)\.([a-zA-Z]{2,5})$",
+            user.user_principal_name or "",
+        ):
+            email = user.user_principal_name
+        else:
+            email = "NA"
+    last_login = None
+    if user.sign_in_activity:
+        last_login = user.sign_in_activity.last_sign_in_date_time
+    return {
+        "user_id": user.id,
+        "name": user.display_name,
+        "email": email,
+        "company": user.company_name,
+        "last_login": last_login,
+    }
+
+
+@functools.lru_cache(maxsize=1)
+def _internal_domains(domains: str | tuple[str, ...] | None) -> frozenset[str]:
+    if isinstance(domains, str):
+        domains = tuple(domains.split(","))
+    return frozenset(domain.strip().lower() for domain in domains or () if domain.strip())
+
+
+def is_internal_email(email: str) -> bool:
+    """
+    Check if the email belongs to the organisation.
+
+    Its domain, or one of the domain's labels like "cowi" in "cowi.dk", has to be in INTERNAL_EMAIL_DOMAINS_LIST.
+    The list is parsed into a set once, whether it is configured as a list or a comma separated string.
+    """
+    domains = settings.INTERNAL_EMAIL_DOMAINS_LIST
+    internal = _internal_domains(domains if domains is None or isinstance(domains, str) else tuple(domains))
+    domain = email.rpartition("@")[2].lower()
+    return domain in internal or any(label in internal for label in domain.split("."))
 
 
+def principal_name(email: str) -> str:
+    """The user principal name of an email in Azure Active Directory"""
+    if is_internal_email(email):
+        return email
+    # externals have principal name formatted like xxxx_gmail.com#EXT#@cowi.onmicrosoft.com
+    return f"{email.replace('@', '_')}#EXT#@{settings.DEFAULT_AD_FQDN}"
+
+
+async def fetch_user_by_email(email: str) -> User | None:
+    graph = get_graph_client()
+    return await graph.users.by_user_id(principal_name(email)).get()
+
+
+@single_flight(key=lambda email: email)
 async def get_aad_user_by_email(email: str) -> dict[str, str]:
-    """Check if user exists in Azure Active Directory"""
+    """Check if user exists in Azure Active Directory. Concurrent lookups of one email share a Graph call."""
     user_data = await cache.get(email, namespace="azure_emails")
     if user_data:
+        emails_refresher.touch([email])
         return user_data  # type: ignore
 
-    scopes = ["https://graph.microsoft.com/.default"]
-    graph = GraphServiceClient(credentials=get_credentials(), scopes=scopes)
-    # headers = {"Content-Type": "application/json"}
-
-    # construct user principal name
-    user_principal_name = email
-    # check if user is an external user
-    if not any(domain in email for domain in settings.INTERNAL_EMAIL_DOMAINS_LIST):
-        # externals have principal name formatted like
-        # xxxx_gmail.com%23EXT%23@cowi.onmicrosoft.com
-        user_principal_name = user_principal_name.replace("@", "_")
-        user_principal_name += f"%23EXT%23@{settings.DEFAULT_AD_FQDN}"
-    user = await graph.users.by_user_id(user_principal_name).get()
+    user = await fetch_user_by_email(email)
     if user:
-        await cache.add(email, user, namespace="azure_emails", ttl=60 * 5)
+        await cache.set(email, user, namespace="azure_emails")
+        emails_refresher.track([email])
     return user  # type: ignore
 
 
+async def fetch_users_by_emails(emails: list[str]) -> dict[str, Any]:
+    """
+    Fetch users by email from Graph like `fetch_users_from_azure`, returning the User or exception for each email.
+
+    The users are fetched with all their default fields, like `fetch_user_by_email` does,
+    as both fill the azure_emails cache.
+    """
+    principal_names = {principal_name(email): email for email in emails}
+    fetched = await fetch_users_from_azure(list(principal_names), select=None)
+    return {principal_names[name]: user for name, user in fetched.items()}
+
+
+async def get_aad_users_by_emails(emails: list[str]) -> dict[str, User | None]:
+    """
+    Look up many emails in Azure Active Directory at once, e.g. when importing a project team.
+
+    Duplicates are looked up once, cached users are read in one go and the others are fetched
+    in $batch requests. Returns the user of each distinct email, or None when it isn't in Azure.
+    Failed lookups are logged and returned as None, MSGraphException is only raised when all failed.
+    """
+    unique_emails = list(dict.fromkeys(emails))
+    cached = await cache.multi_get(unique_emails, namespace="azure_emails")
+    users = dict(zip(unique_emails, cached))
+    missing_emails = [email for email, user in users.items() if user is None]
+    emails_refresher.touch(email for email, user in users.items() if user is not None)
+    if not missing_emails:
+        return users
+
+    failed_emails = []
+    for email, user in (await fetch_users_by_emails(missing_emails)).items():
+        if isinstance(user, APIError) and user.response_status_code == 404:
+            user = None
+        elif isinstance(user, BaseException):
+            logger.error(f"Failed to fetch user {email} via Graph API: {user}")
+            failed_emails.append(email)
+            user = None
+        users[email] = user
+
+    if failed_emails and len(failed_emails) == len(unique_emails):
+        raise exceptions.MSGraphException(f"Failed to fetch users via Graph API: {', '.join(failed_emails)}")
+
+    found = [(email, users[email]) for email in missing_emails if users[email] is not None]
+    await cache.multi_set(pairs=found, namespace="azure_emails")
+    emails_refresher.track(email for email, _ in found)
+    return users
+
+
+async def refresh_users_by_emails(emails: list[str]) -> dict[str, Any]:
+    """Fetch the users of the emails refresh-ahead found due, leaving out the ones that failed"""
+    fetched = await fetch_users_by_emails(emails)
+    return {email: user for email, user in fetched.items() if not isinstance(user, BaseException)}
+
+
 async def invite_user_to_aad(email: str, name: str, platform_url: str) -> Response:
     """
     invites a user to organization's Active Directory
@@ -70,8 +373,7 @@ async def invite_user_to_aad(email: str, name: str, platform_url: str) -> Respon
         http response received from Graph API
     """
 
-    scopes = ["https://graph.microsoft.com/.default"]
-    graph = GraphServiceClient(credentials=get_credentials(), scopes=scopes)
+    graph = get_graph_client()
 
     request_body = Invitation(
         invited_user_email_address=email,
@@ -86,8 +388,89 @@ async def invite_user_to_aad(email: str, name: str, platform_url: str) -> Respon
     return response
 
 
+async def fetch_users_batch(
+    graph: GraphServiceClient, user_ids: list[str], select: list[str] | None = USER_FIELDS
+) -> dict[str, User | APIError]:
+    """
+    Fetch up to GRAPH_BATCH_LIMIT users with one JSON $batch request, with only the `select` fields when given.
+
+    Users that don't exist are returned as an APIError with status 404, throttled ones as an APIError
+    with the status and headers of their response. The others are only returned when answered with
+    status 200, the caller fetches the rest one by one.
+    """
+    query = f"?$select={','.join(select)}" if select else ""
+    body = {
+        "requests": [
+            {"id": str(index), "method": "GET", "url": f"/users/{quote(user_id, safe='@')}{query}"}
+            for index, user_id in enumerate(user_ids)
+        ]
+    }
+    request_info = RequestInformation(Method.POST, "{+baseurl}/$batch")
+    request_info.headers.try_add("Accept", "application/json")
+    request_info.set_stream_content(json.dumps(body).encode(), "application/json")
+    request_info.add_request_options([NO_CLIENT_RETRIES])
+    content = await graph.request_adapter.send_primitive_async(request_info, "bytes", {})  # type: ignore[func-returns-value]
+
+    users: dict[str, User | APIError] = {}
+    parse_node_factory = JsonParseNodeFactory()
+    for response in json.loads(content or b"{}").get("responses", []):
+        user_id = user_ids[int(response["id"])]
+        if response.get("status") == 404:
+            users[user_id] = APIError(f"User {user_id} not found", response_status_code=404)
+        elif response.get("status") in RETRY_STATUS_CODES:
+            users[user_id] = APIError(
+                f"Fetching user {user_id} was throttled",
+                response_status_code=response["status"],
+                response_headers=response.get("headers") or {},
+            )
+        elif response.get("status") == 200:
+            user_content = json.dumps(response["body"]).encode()
+            parse_node = parse_node_factory.get_root_parse_node("application/json", user_content)
+            users[user_id] = parse_node.get_object_value(User)
+    return users
+
+
+async def fetch_users_batch_with_retries(
+    graph: GraphServiceClient, semaphore: asyncio.Semaphore, user_ids: list[str], select: list[str] | None = USER_FIELDS
+) -> dict[str, User | APIError]:
+    """
+    Fetch users with `fetch_users_batch`, batching the throttled ones again up to GRAPH_MAX_RETRIES times.
+
+    Waits for the longest Retry-After of the throttled users, without holding the semaphore.
+    Users still throttled after the last retry, or asked to wait longer than GRAPH_MAX_RETRY_DELAY,
+    are returned as their APIError.
+    """
+    fetched: dict[str, User | APIError] = {}
+    pending = user_ids
+    for attempt in range(settings.GRAPH_MAX_RETRIES + 1):
+        batch = await with_retries(semaphore, lambda pending=pending: fetch_users_batch(graph, pending, select))
+        fetched.update(batch)
+        throttled = {
+            user_id: error
+            for user_id, error in batch.items()
+            if isinstance(error, APIError) and error.response_status_code in RETRY_STATUS_CODES
+        }
+        if not throttled or attempt == settings.GRAPH_MAX_RETRIES:
+            break
+
+        delays = {user_id: retry_delay(error, attempt) for user_id, error in throttled.items()}
+        pending = [user_id for user_id, delay in delays.items() if delay <= settings.GRAPH_MAX_RETRY_DELAY]
+        if not pending:
+            break
+        delay = max(delays[user_id] for user_id in pending)
+        logger.warning(f"Graph API throttled {len(pending)} users of a $batch, retrying in {delay}s")
+        await asyncio.sleep(delay)
+    return fetched
+
+
 async def get_users_from_azure(user_ids: str | list[str]) -> list[dict[str, str]]:
-    """Fetch Users from Azure Active Directory"""
+    """
+    Fetch Users from Azure Active Directory
+
+    Users missing from the cache are fetched concurrently, at most GRAPH_MAX_CONCURRENCY requests at a time,
+    in $batch requests of GRAPH_BATCH_SIZE users. Users missing from a batch response are fetched one by one.
+    Users that fail to be fetched are logged and left out, MSGraphException is only raised when none could be fetched.
+    """
 
     if not user_ids:
         return [{}]
@@ -98,42 +481,109 @@ async def get_users_from_azure(user_ids: str | list[str]) -> list[dict[str, str]
     user_data = await cache.multi_get(user_ids, namespace="azure_users")
     users = {user_id: user_data[index] for index, user_id in enumerate(user_ids)}
     missing_users = [user_id for user_id, user_data in users.items() if user_data is None]
+    users_refresher.touch(user_id for user_id, user_data in users.items() if user_data is not None)
+
+    fetched = await fetch_users_from_azure(missing_users)
+
+    failed_users = []
+    found = []
+    for user_id in missing_users:
+        user = fetched[user_id]
+        if isinstance(user, BaseException):
+            logger.error(f"Failed to fetch user {user_id} via Graph API: {user}")
+            failed_users.append(user_id)
+            del users[user_id]
+        elif user:
+            users[user.id] = user_to_dict(user)
+            found.append((user.id, users[user.id]))
+
+    if failed_users and len(failed_users) == len(user_ids):
+        raise exceptions.MSGraphException(f"Failed to fetch users via Graph API: {', '.join(failed_users)}")
+
+    # only the fetched users, writing cached ones again would refresh their TTL in the shared backend
+    await cache.multi_set(pairs=found, namespace="azure_users")
+    users_refresher.track(user_id for user_id, _ in found)
+    return list(users.values())
+
+
+async def fetch_users_from_azure(user_ids: list[str], select: list[str] | None = USER_FIELDS) -> dict[str, Any]:
+    """
+    Fetch users from Graph, returning the User, None or the exception raised for each id.
+    Only the `select` fields of the users are fetched, all their default fields when it is None.
 
+    Users are fetched concurrently, at most GRAPH_MAX_CONCURRENCY requests at a time, in $batch requests
+    of GRAPH_BATCH_SIZE users. Users throttled in a batch response are batched again after their Retry-After,
+    other users missing from a batch response are fetched one by one.
+    """
     query_params = UserItemRequestBuilder.UserItemRequestBuilderGetQueryParameters(
-        select=["id", "displayName", "mail", "userPrincipalName", "companyName", "signInActivity"],
+        select=select,
     )
 
-    scopes = ["https://graph.microsoft.com/.default"]
-    graph = GraphServiceClient(credentials=get_credentials(), scopes=scopes)
+    graph = get_graph_client()
 
-    request_configuration = RequestConfiguration(query_parameters=query_params)
+    request_configuration = RequestConfiguration(query_parameters=query_params, options=[NO_CLIENT_RETRIES])
+    semaphore = asyncio.Semaphore(settings.GRAPH_MAX_CONCURRENCY)
+    fetched: dict[str, Any] = {}
 
-    for user_id in missing_users:
-        try:
-            user = await graph.users.by_user_id(user_id).get(request_configuration=request_configuration)
-        except Exception as e:
-            logger.error(f"Failed to fetch user {user_id} via Graph API: {e}")
-            raise exceptions.MSGraphException(f"Failed to fetch users via Graph API: {user_id}")
-        if user:
-            email = user.mail
-            # some accounts have null emails
-            if not email:
-                if re.match(
-                    r"^([a-zA-Z0-9_\-\.]+)@([a-zA-Z0-9_\-\.]+)\.([a-zA-Z]{2,5})$",
-                    user.user_principal_name or "",
-                ):
-                    email = user.user_principal_name
-                else:
-                    email = "NA"
-            last_login = None
-            if user.sign_in_activity:
-                last_login = user.sign_in_activity.last_sign_in_date_time
-            users[user.id] = {  # type: ignore
-                "user_id": user.id,
-                "name": user.display_name,
-                "email": email,
-                "company": user.company_name,
-                "last_login": last_login,
-            }
-    await cache.multi_set(pairs=users.items(), ttl=60 * 5, namespace="azure_users")
-    return list(users.values())
+    batch_size = min(settings.GRAPH_BATCH_SIZE, GRAPH_BATCH_LIMIT)
+    if batch_size > 1 and len(user_ids) > 1:
+        chunks = [user_ids[index : index + batch_size] for index in range(0, len(user_ids), batch_size)]
+        batches = await asyncio.gather(
+            *(fetch_users_batch_with_retries(graph, semaphore, chunk, select) for chunk in chunks),
+            return_exceptions=True,
+        )
+        for batch in batches:
+            if isinstance(batch, BaseException):
+                logger.warning(f"Failed to fetch users via Graph API $batch, fetching them one by one: {batch}")
+            else:
+                fetched.update(batch)
+
+    single_users = [user_id for user_id in user_ids if user_id not in fetched]
+    results = await asyncio.gather(
+        *(
+            with_retries(
+                semaphore,
+                lambda user_id=user_id: graph.users.by_user_id(user_id).get(
+                    request_configuration=request_configuration
+                ),
+            )
+            for user_id in single_users
+        ),
+        return_exceptions=True,
+    )
+    fetched.update(zip(single_users, results))
+    return fetched
+
+
+async def refresh_users(user_ids: list[str]) -> dict[str, dict[str, Any]]:
+    """Fetch the users refresh-ahead found due, leaving out the ones that failed"""
+    fetched = await fetch_users_from_azure(user_ids)
+    return {
+        user_id: user_to_dict(user)
+        for user_id, user in fetched.items()
+        if user is not None and not isinstance(user, BaseException)
+    }
+
+
+users_refresher = RefreshAhead(
+    cache,
+    "azure_users",
+    refresh_users,
+    window=settings.USER_REFRESH_WINDOW,
+    ahead=settings.USER_REFRESH_BEFORE,
+    maxsize=settings.USER_CACHE_MAX_SIZE,
+    batch_size=max(min(settings.GRAPH_BATCH_SIZE, GRAPH_BATCH_LIMIT), 1),
+    concurrency=settings.USER_REFRESH_CONCURRENCY,
+    enabled=settings.USER_REFRESH_AHEAD,
+)
+emails_refresher = RefreshAhead(
+    cache,
+    "azure_emails",
+    refresh_users_by_emails,
+    window=settings.USER_REFRESH_WINDOW,
+    ahead=settings.USER_REFRESH_BEFORE,
+    maxsize=settings.USER_CACHE_MAX_SIZE,
+    batch_size=max(min(settings.GRAPH_BATCH_SIZE, GRAPH_BATCH_LIMIT), 1),
+    concurrency=settings.USER_REFRESH_CONCURRENCY,
+    enabled=settings.USER_REFRESH_AHEAD,
+)
@@ -1,6 +1,19 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import inspect
+import json
+import logging
+from collections.abc import Awaitable, Callable
+from importlib.util import find_spec
+from typing import Any
+
 import httpx
-from aiocache import cached
 from fastapi_azure_auth.user import User
+from strawberry.dataloader import DataLoader
+
+from lcaplatform_config.cache import MISSING, LRUCache, SingleFlight
 
 try:
     from core.config import settings
@@ -9,44 +22,234 @@ except (ImportError, ModuleNotFoundError):
 
     settings = config.Settings()
 
+_client: httpx.AsyncClient | None = None
+_client_loop: asyncio.AbstractEventLoop | None = None
+_closing: set[asyncio.Task] = set()
+_loaders: dict[str, "RouterLoaders"] = {}
+permission_cache = LRUCache("permissions", maxsize=settings.PERMISSION_CACHE_MAX_SIZE)
+permission_flights = SingleFlight()
+
+logger = logging.getLogger(__name__)
 
-@cached(ttl=60)
-async def project_exists(project_id: str, token: str) -> bool | list[dict]:
+
+def get_client() -> httpx.AsyncClient:
     """
-    Checks whether the project exists. The function is cached with a decorator.
-    Args:
-        project_id: the ProjectID that the user is navigating inside.
-        token: the user's PAT
+    Return the pooled client shared by all calls to the router, creating it on first use.
 
-    Returns:
-        boolean:
-            True if the user trying to access the resources is a member of that Project
-            else False
+    Connections are bound to the event loop that opened them, so a new client is created
+    when it is requested from another loop and the previous client is closed. HTTP/2 is only used when `h2` is installed.
+    Authorization headers are passed per request, never set on the client.
     """
+    global _client, _client_loop
 
-    query = """
-        query($id: String!) {
-            projects(filters: {id: {equal: $id}}) {
-                id
-                public
-            }
-        }
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        if _client is not None and not _client.is_closed:
+            task = loop.create_task(close_client(_client))
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+        _client = httpx.AsyncClient(
+            http2=settings.ROUTER_HTTP2 and find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_connections=settings.ROUTER_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.ROUTER_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.ROUTER_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(settings.ROUTER_TIMEOUT, connect=settings.ROUTER_CONNECT_TIMEOUT),
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close_client(client: httpx.AsyncClient) -> None:
+    """Close a replaced router client's connections, logging rather than raising failures"""
+    try:
+        await client.aclose()
+    except Exception as e:
+        logger.warning(f"Failed to close the router client: {e}")
+
+
+async def startup() -> httpx.AsyncClient:
+    """Create the shared router client, meant to be called from the FastAPI lifespan together with `dispose`"""
+    return get_client()
+
+
+async def dispose() -> None:
+    """Close the shared router client and its connections"""
+    global _client, _client_loop
+
+    client = _client
+    _client = None
+    _client_loop = None
+
+    if client is not None:
+        await client.aclose()
+
+
+class RouterLoaders:
+    """
+    Batches the project and group lookups made with one token into a single router call per event-loop tick.
+
+    Can be created per request and kept in the GraphQL context, which also memoizes the results
+    for the request. `project_exists` and `group_exists` share one per token and tick, see `get_loaders`.
     """
 
-    async with httpx.AsyncClient(
-        headers={"authorization": f"Bearer {token}"},
-    ) as client:
-        response = await client.post(
+    def __init__(self, token: str) -> None:
+        self.token = token
+        self.projects: DataLoader[str, bool | dict] = DataLoader(load_fn=self.load_projects)
+        self.groups: DataLoader[tuple[str, str], bool] = DataLoader(load_fn=self.load_groups)
+
+    async def query(self, query: str, variables: dict) -> tuple[dict, set[str] | None]:
+        """
+        Send a query to the router.
+
+        Returns the data and the root fields that failed, None meaning that the whole query failed.
+        """
+        response = await get_client().post(
             f"{settings.ROUTER_URL}/graphql",
             json={
                 "query": query,
-                "variables": {"id": project_id},
+                "variables": variables,
             },
+            headers={"authorization": f"Bearer {self.token}"},
         )
         data = response.json()
-        if response.is_error or data.get("errors"):
-            return False
-        return data.get("data")  # type: ignore
+        errors = data.get("errors")
+        if response.is_error or (errors and not isinstance(errors, list)):
+            return {}, None
+
+        failed: set[str] = set()
+        for error in errors or []:
+            path = error.get("path") if isinstance(error, dict) else None
+            if not path:
+                return {}, None
+            failed.add(path[0])
+        return data.get("data") or {}, failed
+
+    async def load_projects(self, project_ids: list[str]) -> list[bool | dict]:
+        query = """
+            query($ids: [String!]!) {
+                projects(filters: {id: {isAnyOf: $ids}}) {
+                    id
+                    public
+                }
+            }
+        """
+
+        data, failed = await self.query(query, {"ids": project_ids})
+        if failed is None or failed:
+            return [False] * len(project_ids)
+
+        projects = data.get("projects") or []
+        return [{"projects": [project for project in projects if project["id"] == _id]} for _id in project_ids]
+
+    async def load_groups(self, keys: list[tuple[str, str]]) -> list[bool]:
+        group_ids: dict[str, list[str]] = {}
+        for project_id, group_id in keys:
+            group_ids.setdefault(project_id, []).append(group_id)
+
+        # one aliased root field per project
+        aliases = {project_id: f"project{index}" for index, project_id in enumerate(group_ids)}
+        variables: dict[str, str | list[str]] = {}
+        for project_id, alias in aliases.items():
+            variables[f"{alias}Id"] = project_id
+            variables[f"{alias}GroupIds"] = group_ids[project_id]
+        definitions = ", ".join(f"${alias}Id: String!, ${alias}GroupIds: [String!]!" for alias in aliases.values())
+        fields = "\n".join(
+            f"{alias}: projectGroups(projectId: ${alias}Id, filters: {{id: {{isAnyOf: ${alias}GroupIds}}}}) {{ id }}"
+            for alias in aliases.values()
+        )
+        query = f"query({definitions}) {{\n{fields}\n}}"
+
+        _data, failed = await self.query(query, variables)
+        if failed is None:
+            return [False] * len(keys)
+        return [aliases[project_id] not in failed for project_id, _ in keys]
+
+
+def get_loaders(token: str) -> RouterLoaders:
+    """Return the loaders shared by all lookups with this token in the current event-loop tick"""
+    loaders = _loaders.get(token)
+    if loaders is None:
+        loaders = _loaders[token] = RouterLoaders(token)
+        asyncio.get_running_loop().call_soon(_loaders.pop, token, None)
+    return loaders
+
+
+def token_subject(token: str) -> str:
+    """
+    Identify the user of a token by its `oid` claim, falling back to `sub`, or a hash of the token if it has neither.
+
+    The signature is not checked here, the token must already have been validated, e.g. by `azure_scheme`.
+    """
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        subject = claims.get("oid") or claims.get("sub")
+    except (IndexError, ValueError, AttributeError):
+        subject = None
+    return subject or hashlib.sha256(token.encode()).hexdigest()
+
+
+def cached_permission(
+    func: Callable[..., Awaitable[Any]] | None = None, *, is_positive: Callable[[Any], bool] = bool
+) -> Any:
+    """
+    Cache a permission check per user instead of per token, so refreshed tokens keep hitting the cache.
+
+    Positive results, as told by `is_positive`, live for PERMISSION_CACHE_TTL seconds, negative ones for
+    PERMISSION_CACHE_NEGATIVE_TTL. Concurrent misses for the same key share one call. Within
+    PERMISSION_CACHE_STALE_TTL after expiry the expired result is returned right away and refreshed in the background.
+    Used as `@cached_permission` or `@cached_permission(is_positive=...)`.
+    """
+    if func is None:
+        return functools.partial(cached_permission, is_positive=is_positive)
+
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        arguments = signature.bind(*args, **kwargs).arguments
+        key = (func.__name__, *(value for name, value in arguments.items() if name != "token"))
+        key += (token_subject(arguments["token"]),)
+
+        async def call() -> Any:
+            result = await func(*args, **kwargs)
+            ttl = settings.PERMISSION_CACHE_TTL if is_positive(result) else settings.PERMISSION_CACHE_NEGATIVE_TTL
+            permission_cache.set(key, result, ttl=ttl, stale_ttl=settings.PERMISSION_CACHE_STALE_TTL)
+            return result
+
+        result, fresh = permission_cache.lookup(key)
+        if result is MISSING:
+            return await permission_flights.run(key, call)
+        if not fresh:
+            permission_flights.start(key, call)
+        return result
+
+    return wrapper
+
+
+def has_projects(result: bool | dict) -> bool:
+    """Whether a `project_exists` result found the project, `{"projects": []}` meaning it didn't"""
+    return bool(result.get("projects")) if isinstance(result, dict) else result
+
+
+@cached_permission(is_positive=has_projects)
+async def project_exists(project_id: str, token: str) -> bool | dict:
+    """
+    Checks whether the project exists. The function is cached per user with a decorator.
+    Concurrent calls with the same token are batched into one router call.
+    Args:
+        project_id: the ProjectID that the user is navigating inside.
+        token: the user's PAT
+
+    Returns:
+        boolean:
+            True if the user trying to access the resources is a member of that Project
+            else False
+    """
+
+    return await get_loaders(token).projects.load(project_id)
 
 
 def is_super_admin(user: User) -> bool:
@@ -55,10 +258,11 @@ def is_super_admin(user: User) -> bool:
     return "lca_super_admin" in user.roles
 
 
-@cached(ttl=60)
+@cached_permission
 async def group_exists(project_id: str, group_id: str, token: str) -> bool:
     """
-    Checks whether the group exists. The function is cached with a decorator.
+    Checks whether the group exists. The function is cached per user with a decorator.
+    Concurrent calls with the same token are batched into one router call.
     Args:
         project_id: the ProjectID that the user is navigating inside.
         group_id: the GroupID of the Project Group the user is interacting with.
@@ -69,25 +273,4 @@ async def group_exists(project_id: str, group_id: str, token: str) -> bool:
         else False
     """
 
-    query = """
-    query($projectId: String!, $id: String!) {
-        projectGroups(projectId: $projectId, filters: {id: {equal: $id}}) {
-            id
-        }
-    }
-    """
-
-    async with httpx.AsyncClient(
-        headers={"authorization": f"Bearer {token}"},
-    ) as client:
-        response = await client.post(
-            f"{settings.ROUTER_URL}/graphql",
-            json={
-                "query": query,
-                "variables": {"projectId": project_id, "id": group_id},
-            },
-        )
-        data = response.json()
-        if response.is_error or data.get("errors"):
-            return False
-        return True
+    return await get_loaders(token).groups.load((project_id, group_id))
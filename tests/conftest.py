@@ -1,4 +1,5 @@
 import datetime
+import json
 import os
 from unittest.mock import AsyncMock
 
@@ -36,6 +37,9 @@ async def mock_graph_client(mocker):
     graph_client_mock = mocker.patch(
         "lcaplatform_config.user.GraphServiceClient",
     )
+    auth_provider_mock = mocker.patch("lcaplatform_config.user.AzureIdentityAuthenticationProvider")
+    for name in ("_graph_client", "_http_client", "_credentials", "_graph_loop"):
+        mocker.patch.object(user, name, None)
     graph_client_obj = graph_client_mock.return_value
 
     return_user = mocker.MagicMock()
@@ -54,9 +58,84 @@ async def mock_graph_client(mocker):
     graph_client_obj.invitations.post = AsyncMock(return_value="RESPONSE")
 
     graph_client_mock.graph_client_obj = graph_client_obj
+    graph_client_mock.auth_provider = auth_provider_mock
 
     config.Settings()
 
     yield graph_client_mock
 
     await user.cache.clear()
+
+
+@pytest.fixture
+async def graph_stand_in(mocker):
+    """
+    A real GraphServiceClient talking to an in-process stand-in of the Graph API.
+
+    Known users are answered from `users` both in $batch and single requests, unknown users get a 404.
+    Like Graph, a $select leaves out the other fields of the users.
+    Users in `failing_items` get the statuses listed there in $batch responses, with a Retry-After of 0.
+    Single requests of users in `failing_requests` get the statuses listed there, with a Retry-After of 0.
+    Every request is recorded in `requests` as (method, path, number of batched requests).
+    The client has the middleware of the production client, retry handler included.
+    """
+    from urllib.parse import parse_qs, unquote, urlsplit
+
+    import httpx
+    from kiota_abstractions.authentication import AnonymousAuthenticationProvider
+    from msgraph import GraphRequestAdapter, GraphServiceClient
+    from msgraph_core import GraphClientFactory
+
+    users: dict[str, dict] = {}
+    requests: list[tuple[str, str, int]] = []
+    failing_batches: list[int] = []
+    failing_items: dict[str, list[int]] = {}
+    failing_requests: dict[str, list[int]] = {}
+
+    def get_user(user_id: str, select: str | None = None) -> tuple[int, dict]:
+        if user_id in users:
+            fields = select.split(",") if select else list(users[user_id])
+            return 200, {field: value for field, value in users[user_id].items() if field in fields}
+        return 404, {"error": {"code": "Request_ResourceNotFound", "message": f"User {user_id} not found"}}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/v1.0/$batch":
+            batch = json.loads(request.content)["requests"]
+            requests.append(("POST", request.url.path, len(batch)))
+            if failing_batches:
+                return httpx.Response(failing_batches.pop(0), json={"error": {"code": "serviceNotAvailable"}})
+            responses = []
+            for item in batch:
+                url = urlsplit(item["url"])
+                user_id = unquote(url.path.removeprefix("/users/"))
+                status, body = get_user(user_id, parse_qs(url.query).get("$select", [None])[0])
+                headers = {}
+                if failing_items.get(user_id):
+                    status, body = failing_items[user_id].pop(0), {"error": {"code": "serviceNotAvailable"}}
+                    headers = {"Retry-After": "0"}
+                responses.append({"id": item["id"], "status": status, "headers": headers, "body": body})
+            return httpx.Response(200, json={"responses": responses})
+
+        requests.append(("GET", request.url.path, 1))
+        user_id = unquote(request.url.path.removeprefix("/v1.0/users/"))
+        if failing_requests.get(user_id):
+            status = failing_requests[user_id].pop(0)
+            return httpx.Response(status, headers={"Retry-After": "0"}, json={"error": {"code": "throttled"}})
+        status, body = get_user(user_id, request.url.params.get("$select"))
+        return httpx.Response(status, json=body)
+
+    client = GraphClientFactory.create_with_default_middleware(
+        client=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    adapter = GraphRequestAdapter(AnonymousAuthenticationProvider(), client=client)
+    graph = GraphServiceClient(request_adapter=adapter)
+    graph.stand_in_users = users
+    graph.stand_in_requests = requests
+    graph.stand_in_failing_batches = failing_batches
+    graph.stand_in_failing_items = failing_items
+    graph.stand_in_failing_requests = failing_requests
+    mocker.patch("lcaplatform_config.user.get_graph_client", return_value=graph)
+
+    yield graph
+
+    await user.cache.clear()
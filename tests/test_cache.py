@@ -0,0 +1,221 @@
+import asyncio
+import time
+
+from aiocache import Cache
+from prometheus_client import REGISTRY
+
+from lcaplatform_config.cache import MISSING, LRUCache, RefreshAhead, SingleFlight, TieredCache, single_flight
+
+
+def test_lru_cache_get_set():
+    cache = LRUCache("test-get-set", maxsize=10)
+
+    assert cache.get("key") is MISSING
+    cache.set("key", False, ttl=60)
+
+    assert cache.get("key") is False
+    assert cache.get("other", None) is None
+    assert REGISTRY.get_sample_value("cache_hits_total", {"cache": "test-get-set"}) == 1
+    assert REGISTRY.get_sample_value("cache_misses_total", {"cache": "test-get-set"}) == 2
+
+
+def test_lru_cache_expiry(mocker):
+    cache = LRUCache("test-expiry", maxsize=10)
+    cache.set("key", "value", ttl=60)
+
+    mocker.patch("lcaplatform_config.cache.time.monotonic", return_value=cache._data["key"][0])
+
+    assert cache.get("key") is MISSING
+    assert len(cache) == 0
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache("test-eviction", maxsize=2)
+    cache.set("a", 1, ttl=60)
+    cache.set("b", 2, ttl=60)
+    cache.get("a")
+    cache.set("c", 3, ttl=60)
+
+    assert len(cache) == 2
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+async def test_single_flight_coalesces_calls():
+    calls = []
+
+    @single_flight()
+    async def fetch(key: str) -> str:
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key.upper()
+
+    results = await asyncio.gather(fetch("a"), fetch("a"), fetch("b"))
+
+    assert results == ["A", "A", "B"]
+    assert calls == ["a", "b"]
+    assert len(fetch.flights) == 0
+    assert await fetch("a") == "A"
+    assert calls == ["a", "b", "a"]
+
+
+async def test_single_flight_shares_exceptions():
+    flights = SingleFlight()
+    calls = 0
+
+    async def fail() -> None:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    results = await asyncio.gather(flights.run("key", fail), flights.run("key", fail), return_exceptions=True)
+
+    assert calls == 1
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+async def test_single_flight_survives_cancelled_caller():
+    flights = SingleFlight()
+
+    async def fetch() -> str:
+        await asyncio.sleep(0.01)
+        return "value"
+
+    cancelled = asyncio.ensure_future(flights.run("key", fetch))
+    waiting = asyncio.ensure_future(flights.run("key", fetch))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+
+    assert await waiting == "value"
+
+
+def test_lru_cache_stale_lookup(mocker):
+    cache = LRUCache("test-stale", maxsize=10)
+    cache.set("key", "value", ttl=60, stale_ttl=30)
+    expires = cache._data["key"][0]
+
+    assert cache.lookup("key") == ("value", True)
+
+    mocker.patch("lcaplatform_config.cache.time.monotonic", return_value=expires)
+    assert cache.lookup("key") == ("value", False)
+    assert cache.get("key") is MISSING
+
+    mocker.patch("lcaplatform_config.cache.time.monotonic", return_value=expires + 30)
+    assert cache.lookup("key") == (MISSING, False)
+
+
+async def test_tiered_cache_shares_backend_between_workers():
+    backend = Cache.from_url("memory://")
+    worker_1 = TieredCache("test-tiered", maxsize=10, backend=backend, ttls={"users": 300}, local_ttl=60)
+    worker_2 = TieredCache("test-tiered", maxsize=10, backend=backend, ttls={"users": 300}, local_ttl=60)
+
+    await worker_1.multi_set([("1", "one"), ("2", "two")], namespace="users")
+
+    assert await worker_2.multi_get(["1", "2", "3"], namespace="users") == ["one", "two", None]
+    assert worker_2.local.get(("users", "1")) == "one"
+    assert await backend.get("1", namespace="users") == "one"
+    assert REGISTRY.get_sample_value("cache_hits_total", {"cache": "test-tiered_shared"}) == 2
+    assert REGISTRY.get_sample_value("cache_misses_total", {"cache": "test-tiered_shared"}) == 1
+
+    await backend.clear()
+    assert await worker_2.get("1", namespace="users") == "one"  # still in the in-process tier
+    await backend.close()
+
+
+async def test_tiered_cache_ttls(mocker):
+    backend = Cache.from_url("memory://")
+    set_mock = mocker.spy(backend, "set")
+    cache = TieredCache("test-tiered-ttls", maxsize=10, backend=backend, ttls={"users": 300}, local_ttl=60)
+
+    await cache.set("1", "one", namespace="users")
+    await cache.set("2", "two", ttl=10, namespace="users")
+
+    assert set_mock.call_args_list[0].kwargs["ttl"] == 300
+    assert set_mock.call_args_list[1].kwargs["ttl"] == 10
+    fresh_until = {key: entry[0] for key, entry in cache.local._data.items()}
+    assert 59 < fresh_until[("users", "1")] - time.monotonic() <= 60
+    assert 9 < fresh_until[("users", "2")] - time.monotonic() <= 10
+
+
+async def test_tiered_cache_in_process_only():
+    cache = TieredCache("test-tiered-local", maxsize=10, ttls={"users": 300})
+
+    assert await cache.add("1", "one", namespace="users")
+    assert await cache.get("1", namespace="users") == "one"
+    assert await cache.get("1", namespace="other") is None
+
+    await cache.clear(namespace="users")
+    assert await cache.get("1", namespace="users") is None
+
+
+async def test_refresh_ahead_refreshes_hot_entries(mocker):
+    cache = TieredCache("test-refresh", maxsize=10, ttls={"users": 300})
+    fetched = []
+
+    async def fetch(keys):
+        fetched.append(keys)
+        return {key: f"new {key}" for key in keys if key != "failing"}
+
+    refresher = RefreshAhead(cache, "users", fetch, window=300, ahead=60, maxsize=10, batch_size=2, concurrency=2)
+    await cache.multi_set([(key, key) for key in ("1", "2", "3", "cold", "failing")], namespace="users")
+    refresher.track(["1", "2", "3", "cold", "failing"])
+    refresher.touch(["1", "2", "3", "failing"])
+
+    assert refresher.due() == []
+    monotonic = time.monotonic
+    mocker.patch("lcaplatform_config.cache.time.monotonic", lambda: monotonic() + 250)
+
+    assert refresher.due() == ["1", "2", "3", "failing"]
+    assert await refresher.refresh() == 3
+    assert sorted(fetched) == [["1", "2"], ["3", "failing"]]
+    assert await cache.multi_get(["1", "3", "cold"], namespace="users") == ["new 1", "new 3", "cold"]
+    assert refresher.due() == ["failing"]
+    assert REGISTRY.get_sample_value("cache_refreshes_total", {"cache": "users", "result": "refreshed"}) == 3
+    assert REGISTRY.get_sample_value("cache_refreshes_total", {"cache": "users", "result": "failed"}) == 1
+
+
+async def test_refresh_ahead_bounded(mocker):
+    cache = TieredCache("test-refresh-bounded", maxsize=10, ttls={"emails": 300})
+    running = 0
+    peak = 0
+
+    async def fetch(keys):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return {}
+
+    refresher = RefreshAhead(cache, "emails", fetch, window=120, ahead=400, maxsize=8, batch_size=1, concurrency=3)
+    refresher.track(str(index) for index in range(10))
+    refresher.touch(str(index) for index in range(10))
+
+    assert refresher.due() == [str(index) for index in range(2, 10)]
+    await refresher.refresh()
+    assert peak == 3
+    assert REGISTRY.get_sample_value("cache_refresh_tracked_entries", {"cache": "emails"}) == 8
+
+
+async def test_refresh_ahead_forgets_cold_expired_entries(mocker):
+    cache = TieredCache("test-refresh-cold", maxsize=10, ttls={"cold": 300})
+    refresher = RefreshAhead(cache, "cold", mocker.AsyncMock(), window=120, ahead=60, maxsize=10)
+    refresher.track(["1"])
+
+    monotonic = time.monotonic
+    mocker.patch("lcaplatform_config.cache.time.monotonic", lambda: monotonic() + 301)
+
+    assert refresher.due() == []
+    assert len(refresher._entries) == 0
+
+
+async def test_refresh_ahead_disabled(mocker):
+    cache = TieredCache("test-refresh-disabled", maxsize=10, ttls={"disabled": 300})
+    refresher = RefreshAhead(cache, "disabled", mocker.AsyncMock(), window=120, ahead=60, maxsize=10, enabled=False)
+    refresher.track(["1"])
+    refresher.touch(["1"])
+
+    assert len(refresher._entries) == 0
+    assert await refresher.refresh() == 0
@@ -7,3 +7,11 @@ def test_config(settings_env):
     assert settings
     for env_key in settings_env.keys():
         assert hasattr(settings, env_key)
+
+
+def test_config_replica_hosts(settings_env, monkeypatch):
+    monkeypatch.setenv("POSTGRES_REPLICA_HOSTS", "replica0, replica1:5433")
+
+    settings = config.Settings()
+
+    assert settings.POSTGRES_REPLICA_HOSTS == ["replica0", "replica1:5433"]
@@ -1,5 +1,6 @@
 from collections.abc import AsyncGenerator
 
+import pytest
 from sqlalchemy.ext.asyncio import AsyncEngine
 
 
@@ -19,3 +20,228 @@ def test_get_db(settings_env):
 
     assert db
     assert isinstance(db, AsyncGenerator)
+
+
+async def test_get_engine_is_shared(settings_env):
+    from lcaplatform_config import connection
+
+    engine = connection.get_engine()
+
+    assert connection.get_engine() is engine
+    assert connection.get_session_factory() is connection.get_session_factory()
+
+    await connection.dispose()
+    assert connection.get_engine() is not engine
+
+    await connection.dispose()
+
+
+async def test_get_db_uses_shared_engine(settings_env):
+    from lcaplatform_config import connection
+
+    engine = await connection.startup()
+    sessions = [await anext(connection.get_db()) for _ in range(2)]
+
+    assert all(session.bind is engine for session in sessions)
+    assert engine.pool.size() == connection.settings.POSTGRES_POOL_SIZE
+
+    await connection.dispose()
+
+
+async def test_override_engine(settings_env):
+    from lcaplatform_config import connection
+
+    engine = connection.create_postgres_engine()
+    connection.override_engine(engine)
+
+    session = await anext(connection.get_db())
+    assert session.bind is engine
+
+    connection.override_engine(None)
+    assert connection.get_engine() is not engine
+
+    await connection.dispose()
+    await engine.dispose()
+
+
+async def test_get_read_db_without_replicas(settings_env):
+    from lcaplatform_config import connection
+
+    session = await anext(connection.get_read_db())
+
+    assert connection.get_replicas() == []
+    assert session.bind.sync_engine.pool is connection.get_engine().sync_engine.pool
+    assert session.bind.get_execution_options()["postgresql_readonly"] is True
+
+    await connection.dispose()
+
+
+async def test_get_read_db_round_robin(settings_env, mocker):
+    from lcaplatform_config import connection
+
+    mocker.patch.object(connection.settings, "POSTGRES_REPLICA_HOSTS", ["replica0", "replica1:5433"])
+
+    replicas = connection.get_replicas()
+    binds = {(await anext(connection.get_read_db())).bind for _ in range(4)}
+
+    assert [replica.engine.url.host for replica in replicas] == ["replica0", "replica1"]
+    assert replicas[1].engine.url.port == 5433
+    assert binds == {replica.read_engine for replica in replicas}
+
+    await connection.dispose()
+
+
+async def test_unhealthy_replica_is_skipped(settings_env, mocker):
+    from sqlalchemy import text
+
+    from lcaplatform_config import connection
+
+    mocker.patch.object(connection.settings, "POSTGRES_REPLICA_HOSTS", ["127.0.0.1:1"])
+    (replica,) = connection.get_replicas()
+
+    with pytest.raises(OSError):
+        async with replica.engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    assert not replica.healthy
+    assert replica.failures == 1
+    session = await anext(connection.get_read_db())
+    assert session.bind.sync_engine.pool is connection.get_engine().sync_engine.pool
+
+    now = replica.retry_at
+    mocker.patch("lcaplatform_config.connection.time.monotonic", return_value=now)
+    assert connection.get_read_session_factory() is replica.session_factory
+
+    # the backoff doubles on consecutive failures
+    replica.mark_unhealthy()
+    assert replica.retry_at == now + connection.settings.POSTGRES_REPLICA_RETRY_SECONDS * 2
+
+    await connection.dispose()
+
+
+async def test_unreachable_replica_falls_back_to_primary(settings_env, mocker):
+    from lcaplatform_config import connection
+
+    mocker.patch.object(connection.settings, "POSTGRES_REPLICA_HOSTS", ["127.0.0.1:1"])
+    (replica,) = connection.get_replicas()
+    assert replica.healthy
+
+    dependency = connection.get_read_db()
+    session = await anext(dependency)
+    bind = await session.run_sync(lambda sync_session: sync_session.get_bind())
+
+    assert not replica.healthy
+    assert bind.pool is connection.get_engine().sync_engine.pool
+    assert bind.get_execution_options()["postgresql_readonly"] is True
+
+    await dependency.aclose()
+    await connection.dispose()
+
+
+async def test_lazy_db_unused(settings_env, mocker):
+    from lcaplatform_config import connection
+
+    get_factory = mocker.patch("lcaplatform_config.connection.get_session_factory")
+    dependency = connection.get_lazy_db()
+    session = await anext(dependency)
+    await dependency.aclose()
+
+    assert isinstance(session, connection.LazySession)
+    assert not session.is_open
+    get_factory.assert_not_called()
+
+
+async def test_lazy_db_opened_on_first_use(settings_env):
+    from types import SimpleNamespace
+
+    from lcaplatform_config import connection, context
+
+    dependency = connection.get_lazy_read_db()
+    session = await anext(dependency)
+    info = SimpleNamespace(context={"read_session": session})
+
+    assert session.bind.get_execution_options()["postgresql_readonly"] is True
+    assert session.is_open
+    assert context.get_read_session(info) is session.get()
+    assert context.get_session(info) is None
+
+    await dependency.aclose()
+    assert connection.get_engine().pool.checkedout() == 0
+
+    await connection.dispose()
+
+
+def test_instrument_engine(settings_env):
+    from prometheus_client import REGISTRY
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.pool import QueuePool
+
+    from lcaplatform_config import connection
+
+    engine = create_engine("sqlite://", poolclass=QueuePool, pool_size=1, max_overflow=2)
+    connection.instrument_engine(engine, "test-pool")
+
+    with engine.connect() as conn_0, engine.connect() as conn_1:
+        conn_0.execute(text("SELECT 1"))
+        conn_1.execute(text("select 2"))
+        assert REGISTRY.get_sample_value("sqlalchemy_pool_checked_out_connections", {"pool": "test-pool"}) == 2
+        assert REGISTRY.get_sample_value("sqlalchemy_pool_overflow_connections", {"pool": "test-pool"}) == 1
+
+    assert REGISTRY.get_sample_value("sqlalchemy_pool_checked_out_connections", {"pool": "test-pool"}) == 0
+    assert REGISTRY.get_sample_value("sqlalchemy_pool_connection_age_seconds_count", {"pool": "test-pool"}) == 2
+    assert (
+        REGISTRY.get_sample_value(
+            "sqlalchemy_statement_duration_seconds_count", {"pool": "test-pool", "operation": "SELECT"}
+        )
+        == 2
+    )
+    engine.dispose()
+
+
+def test_create_postgres_engine_instrumented(settings_env):
+    from lcaplatform_config.connection import InstrumentedQueuePool, create_postgres_engine
+
+    engine = create_postgres_engine()
+
+    assert isinstance(engine.pool, InstrumentedQueuePool)
+    assert engine.pool.logging_name == "localhost"
+
+
+def test_statement_caches(settings_env, mocker):
+    from lcaplatform_config import connection
+
+    mocker.patch.object(connection.settings, "POSTGRES_STATEMENT_CACHE_SIZE", 250)
+    mocker.patch.object(connection.settings, "POSTGRES_COMPILED_CACHE_SIZE", 1000)
+
+    engine = connection.create_postgres_engine()
+
+    assert engine.sync_engine._compiled_cache.capacity == 1000
+    assert connection._connect_args() == {
+        "ssl": False,
+        "statement_cache_size": 250,
+        "prepared_statement_cache_size": 250,
+    }
+
+
+def test_statement_caches_pgbouncer(settings_env, mocker):
+    from lcaplatform_config import connection
+
+    mocker.patch.object(connection.settings, "POSTGRES_PGBOUNCER", True)
+
+    connect_args = connection._connect_args()
+
+    assert connect_args["statement_cache_size"] == 0
+    assert connect_args["prepared_statement_cache_size"] == 0
+    assert connect_args["prepared_statement_name_func"]() != connect_args["prepared_statement_name_func"]()
+
+
+def test_context_does_not_import_connection():
+    import os
+    import subprocess
+    import sys
+
+    from lcaplatform_config import context
+
+    source = os.path.dirname(os.path.dirname(context.__file__))
+    code = "import sys, lcaplatform_config.context; assert 'lcaplatform_config.connection' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], env={**os.environ, "PYTHONPATH": source}, check=True)
@@ -1,8 +1,20 @@
+import asyncio
+import itertools
+import time
+
 import pytest
+from prometheus_client import REGISTRY
+from python_http_client.exceptions import BadRequestsError, TooManyRequestsError
 
 from lcaplatform_config import email
 
 
+@pytest.fixture(autouse=True)
+def sendgrid_client(mocker):
+    # every test patches SendGridAPIClient, so the shared client must be created again
+    mocker.patch.object(email, "_sendgrid_client", None)
+
+
 @pytest.mark.asyncio
 async def test_send_email_no_kwargs(mocker):
     mail_mock = mocker.patch("lcaplatform_config.email.Mail", return_value="mail_obj")
@@ -68,6 +80,124 @@ async def test_send_email_custom_body(mocker):
     assert sendgrid_mock.mock_calls[1][1] == ("mail_obj",)
 
 
+@pytest.mark.asyncio
+async def test_send_email_does_not_block_loop(mocker):
+    sendgrid_mock = mocker.patch("lcaplatform_config.email.SendGridAPIClient")
+    mocker.patch.object(email.settings, "EMAIL_MAX_WORKERS", 4)
+    mocker.patch.object(email, "_executor", None)
+
+    def slow_send(message):
+        time.sleep(0.2)
+        return "RESPONSE"
+
+    sendgrid_mock.return_value.send.side_effect = slow_send
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.005)
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    results = await asyncio.gather(*(email.send_email("test@email.com", html_body="Hello!") for _ in range(4)))
+    elapsed = time.perf_counter() - start
+    ticker_task.cancel()
+    await email.dispose()
+
+    assert results == ["RESPONSE"] * 4
+    assert elapsed < 0.6  # sent concurrently, not one after another
+    assert max(later - earlier for earlier, later in itertools.pairwise(ticks)) < 0.1
+    assert sendgrid_mock.call_count == 1
+
+
+def test_email_template():
+    template = email.TEMPLATES[email.EmailType.TASK_COMMENT]
+
+    assert template.fields == {"task", "comment"}
+    assert template.render(task="<b>x</b>", comment="a & b", unused="-") == (
+        "Hello, <br>The task <strong>&lt;b&gt;x&lt;/b&gt;</strong> has new comment<br><strong>a &amp; b</strong><br><br>"
+        "With best regards, LCA team. <br><i>This email was generated automatically</i>"
+    )
+    assert "<strong></strong>" in template.render()
+    assert email.EmailTemplate("{count:03d} {name!r}").render(count=7, name="Ann") == "007 &#x27;Ann&#x27;"
+
+
+def test_email_template_render_many():
+    template = email.TEMPLATES[email.EmailType.TASK_STATUS_CHANGE]
+
+    bodies = template.render_many([{"task": "a", "status": "done"}, {"task": "b"}])
+
+    assert bodies == [template.render(task="a", status="done"), template.render(task="b", status="")]
+
+
+def personalizations(send_mock):
+    return [
+        [item["to"][0]["email"] for item in call.args[0].get()["personalizations"]] for call in send_mock.call_args_list
+    ]
+
+
+@pytest.mark.asyncio
+async def test_enqueue_email_coalesces_recipients(mocker):
+    sendgrid_mock = mocker.patch("lcaplatform_config.email.SendGridAPIClient")
+    send_mock = sendgrid_mock.return_value.send
+
+    email.enqueue_email(["a@email.com", "b@email.com"], email.EmailType.TASK_STATUS_CHANGE, task="t", status="done")
+    email.enqueue_email("c@email.com", email.EmailType.TASK_STATUS_CHANGE, task="t", status="done")
+    email.enqueue_email("d@email.com", email.EmailType.TASK_ASSIGN, task="t")
+
+    assert send_mock.call_count == 0  # callers don't wait for SendGrid
+    assert len(email.email_queue) == 4
+    await email.dispose()
+
+    assert len(email.email_queue) == 0
+    assert sorted(sorted(recipients) for recipients in personalizations(send_mock)) == [
+        ["a@email.com", "b@email.com", "c@email.com"],
+        ["d@email.com"],
+    ]
+    assert "done" in send_mock.call_args_list[0].args[0].get()["content"][0]["value"]
+
+
+@pytest.mark.asyncio
+async def test_enqueue_email_splits_personalizations(mocker):
+    send_mock = mocker.patch("lcaplatform_config.email.SendGridAPIClient").return_value.send
+
+    email.enqueue_email([f"user{index}@email.com" for index in range(2500)], html_body="Hello!")
+    await email.dispose()
+
+    assert [len(recipients) for recipients in personalizations(send_mock)] == [1000, 1000, 500]
+    assert REGISTRY.get_sample_value("email_queue_depth") == 0
+
+
+@pytest.mark.asyncio
+async def test_enqueue_email_retries(mocker):
+    send_mock = mocker.patch("lcaplatform_config.email.SendGridAPIClient").return_value.send
+    mocker.patch.object(email.settings, "EMAIL_QUEUE_RETRY_BACKOFF", 0.01)
+    send_mock.side_effect = [TooManyRequestsError(429, "Too Many Requests", b"", {}), "RESPONSE"]
+    sent = REGISTRY.get_sample_value("emails_sent_total", {"result": "sent"}) or 0
+    latency_count = REGISTRY.get_sample_value("email_queue_latency_seconds_count") or 0
+
+    email.enqueue_email("test@email.com", html_body="Hello!")
+    await email.dispose()
+
+    assert send_mock.call_count == 2
+    assert REGISTRY.get_sample_value("emails_sent_total", {"result": "sent"}) == sent + 1
+    assert REGISTRY.get_sample_value("email_queue_latency_seconds_count") == latency_count + 1
+
+
+@pytest.mark.asyncio
+async def test_enqueue_email_does_not_retry_bad_request(mocker):
+    send_mock = mocker.patch("lcaplatform_config.email.SendGridAPIClient").return_value.send
+    send_mock.side_effect = BadRequestsError(400, "Bad Request", b"", {})
+    failed = REGISTRY.get_sample_value("emails_sent_total", {"result": "failed"}) or 0
+
+    email.enqueue_email(["a@email.com", "b@email.com"], html_body="Hello!")
+    await email.dispose()
+
+    assert send_mock.call_count == 1
+    assert REGISTRY.get_sample_value("emails_sent_total", {"result": "failed"}) == failed + 2
+
+
 # working example for sending email
 # @pytest.mark.asyncio
 # async def test_send_email():
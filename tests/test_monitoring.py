@@ -0,0 +1,339 @@
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+from prometheus_client.metrics import MetricWrapperBase
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.sdk.trace.sampling import ParentBasedTraceIdRatio
+from opentelemetry.trace import Status, StatusCode
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from lcaplatform_config import config, monitoring
+from lcaplatform_config.monitoring import PrometheusMiddleware
+
+WORKER = """
+import os, sys
+from lcaplatform_config.monitoring import REQUESTS, REQUESTS_IN_PROGRESS
+
+labels = {"method": "GET", "path": "/items/{item_id}", "app_name": "test-multiprocess"}
+REQUESTS.labels(**labels).inc(int(sys.argv[1]))
+REQUESTS_IN_PROGRESS.labels(**labels).inc()
+print(os.getpid())
+"""
+
+
+def create_app(app_name: str, background: list[str] | None = None, **options) -> Starlette:
+    async def get_item(request: Request) -> JSONResponse:
+        if request.path_params["item_id"] == "missing":
+            return JSONResponse({}, status_code=404)
+        return JSONResponse(
+            {"id": request.path_params["item_id"]}, status_code=201 if request.method == "POST" else 200
+        )
+
+    async def fail(request: Request) -> JSONResponse:
+        raise ValueError("failed")
+
+    async def stream(request: Request) -> StreamingResponse:
+        async def chunks():
+            for chunk in ("a", "b", "c"):
+                await asyncio.sleep(0)
+                yield chunk
+
+        return StreamingResponse(chunks(), background=BackgroundTask(lambda: background.append("done")))
+
+    app = Starlette(
+        routes=[
+            Route("/items/{item_id}", get_item, methods=["GET", "POST"]),
+            Route("/fail", fail),
+            Route("/stream", stream),
+        ]
+    )
+    app.add_middleware(PrometheusMiddleware, app_name=app_name, **options)
+    return app
+
+
+def find_middleware(app: Starlette) -> PrometheusMiddleware:
+    middleware = app.middleware_stack
+    while not isinstance(middleware, PrometheusMiddleware):
+        middleware = middleware.app
+    return middleware
+
+
+def sample(name: str, **labels: str) -> float | None:
+    return REGISTRY.get_sample_value(name, labels)
+
+
+@pytest.fixture
+async def client():
+    background: list[str] = []
+    app = create_app("test-monitoring", background)
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app, raise_app_exceptions=False), base_url="http://test"
+    ) as client:
+        client.background = background
+        yield client
+
+
+@pytest.mark.asyncio
+async def test_prometheus_middleware_records_route(client):
+    labels = {"method": "GET", "path": "/items/{item_id}", "app_name": "test-monitoring"}
+    before = sample("fastapi_requests_total", **labels) or 0
+
+    assert (await client.get("/items/1")).status_code == 200
+    assert (await client.get("/items/2")).status_code == 200
+    assert (await client.post("/items/3")).status_code == 201
+
+    assert sample("fastapi_requests_total", **labels) == before + 2
+    assert sample("fastapi_responses_total", status_code="200", **labels) == before + 2
+    assert sample("fastapi_responses_total", status_code="201", **{**labels, "method": "POST"}) == 1
+    assert sample("fastapi_requests_duration_seconds_count", **labels) == before + 2
+    assert sample("fastapi_requests_in_progress", **labels) == 0
+
+
+@pytest.mark.asyncio
+async def test_prometheus_middleware_skips_unknown_paths(client):
+    assert (await client.get("/unknown")).status_code == 404
+
+    assert sample("fastapi_requests_total", method="GET", path="/unknown", app_name="test-monitoring") is None
+
+
+@pytest.mark.asyncio
+async def test_prometheus_middleware_records_exceptions(client):
+    labels = {"method": "GET", "path": "/fail", "app_name": "test-monitoring"}
+
+    assert (await client.get("/fail")).status_code == 500
+
+    assert sample("fastapi_exceptions_total", exception_type="ValueError", **labels) == 1
+    assert sample("fastapi_responses_total", status_code="500", **labels) == 1
+    assert sample("fastapi_requests_in_progress", **labels) == 0
+
+
+@pytest.mark.asyncio
+async def test_prometheus_middleware_streaming_response(client):
+    labels = {"method": "GET", "path": "/stream", "app_name": "test-monitoring"}
+
+    response = await client.get("/stream")
+
+    assert response.text == "abc"
+    assert client.background == ["done"]
+    assert sample("fastapi_responses_total", status_code="200", **labels) == 1
+
+
+@pytest.mark.asyncio
+async def test_prometheus_middleware_caches_route_resolution(mocker):
+    app = create_app("test-monitoring-cache")
+    get_path = mocker.spy(PrometheusMiddleware, "get_path")
+    labels_spy = mocker.spy(MetricWrapperBase, "labels")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        for _ in range(3):
+            await client.get("/items/1")
+        await client.get("/items/2")
+        assert get_path.call_count == 2  # once per method and path
+        assert labels_spy.call_count == 5  # app info, requests, in progress, duration and one response child
+
+        app.add_route("/new", lambda request: JSONResponse({}))
+        await client.get("/items/1")
+        assert get_path.call_count == 3
+
+    labels = {"method": "GET", "path": "/items/{item_id}", "app_name": "test-monitoring-cache"}
+    assert sample("fastapi_requests_total", **labels) == 5
+
+
+@pytest.mark.asyncio
+async def test_prometheus_middleware_route_cache_is_bounded():
+    app = create_app("test-monitoring-bounded", route_cache_size=3)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        for index in range(10):
+            await client.get(f"/unknown/{index}")
+
+    assert len(find_middleware(app)._paths) == 3
+
+
+def test_prometheus_middleware_route_replaced_in_place():
+    app = create_app("test-monitoring-replaced")
+    middleware = PrometheusMiddleware(app, app_name="test-monitoring-replaced")
+    scope = {"type": "http", "method": "GET", "path": "/items/1", "app": app, "root_path": ""}
+
+    assert middleware.resolve_path(scope) == ("/items/{item_id}", True)
+    app.router.routes[0] = Route("/items/{name}", lambda request: JSONResponse({}))
+    middleware.invalidate_routes()
+    assert middleware.resolve_path(scope) == ("/items/{name}", True)
+
+
+def test_prometheus_middleware_routes_added():
+    app = create_app("test-monitoring-added")
+    middleware = PrometheusMiddleware(app, app_name="test-monitoring-added")
+    scope = {"type": "http", "method": "GET", "path": "/added", "app": app, "root_path": "", "headers": []}
+
+    assert middleware.resolve_path(scope) == ("/added", False)
+    app.router.routes.append(Route("/added", lambda request: JSONResponse({})))
+    assert middleware.resolve_path(scope) == ("/added", True)
+
+
+@pytest.mark.asyncio
+async def test_prometheus_middleware_allowlists():
+    app = create_app("test-monitoring-allowlist", methods=["get"], status_classes=["2xx", "5xx"])
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        await client.get("/items/1")
+        await client.post("/items/1")
+        await client.get("/items/missing")
+
+    labels = {"path": "/items/{item_id}", "app_name": "test-monitoring-allowlist"}
+    assert sample("fastapi_responses_total", method="GET", status_code="200", **labels) == 1
+    assert sample("fastapi_responses_total", method="other", status_code="201", **labels) == 1
+    assert sample("fastapi_responses_total", method="GET", status_code="4xx", **labels) == 1
+
+
+def test_multiprocess_metrics(tmp_path, monkeypatch):
+    source = os.path.dirname(os.path.dirname(monitoring.__file__))
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path), "PYTHONPATH": source}
+    pids = [
+        int(subprocess.run([sys.executable, "-c", WORKER, count], env=env, capture_output=True, check=True).stdout)
+        for count in ("2", "3")
+    ]
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    labels = {"method": "GET", "path": "/items/{item_id}", "app_name": "test-multiprocess"}
+
+    registry = monitoring.get_registry()
+    assert registry.get_sample_value("fastapi_requests_total", labels) == 5
+    assert registry.get_sample_value("fastapi_requests_in_progress", labels) == 2
+    body = asyncio.run(monitoring.MetricsExposition(interval=0).get_body())
+    assert b'fastapi_requests_total{app_name="test-multiprocess"' in body
+
+    monitoring.mark_worker_dead(pids[0])
+    registry = monitoring.get_registry()
+    assert registry.get_sample_value("fastapi_requests_total", labels) == 5
+    assert registry.get_sample_value("fastapi_requests_in_progress", labels) == 1
+
+    monitoring.clear_multiprocess_dir()
+    assert os.listdir(tmp_path) == []
+
+
+def test_single_process_registry():
+    assert monitoring.get_registry() is REGISTRY
+
+
+@pytest.mark.asyncio
+async def test_metrics_exposition_is_cached(mocker):
+    exposition = monitoring.MetricsExposition(interval=5)
+    generate_latest = mocker.spy(monitoring, "generate_latest")
+    counter = monitoring.EMAILS_SENT.labels(result="test-exposition")
+
+    before = await exposition.get_body()
+    counter.inc()
+    assert await exposition.get_body() is before
+
+    monotonic = time.monotonic
+    mocker.patch.object(monitoring.time, "monotonic", lambda: monotonic() + 10)
+    after = await exposition.get_body()
+    assert after != before
+    assert b'emails_sent_total{result="test-exposition"} 1.0' in after
+    assert generate_latest.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_metrics_exposition_generates_once_off_the_event_loop(mocker):
+    exposition = monitoring.MetricsExposition(interval=0)
+    threads = []
+    generate_latest = mocker.patch.object(
+        monitoring, "generate_latest", side_effect=lambda registry: threads.append(threading.current_thread()) or b"m"
+    )
+
+    assert await asyncio.gather(*(exposition.get_body() for _ in range(5))) == [b"m"] * 5
+    assert generate_latest.call_count == 1
+    assert threads[0] is not threading.main_thread()
+
+
+@pytest.mark.asyncio
+async def test_metrics_exposition_gzip():
+    app = Starlette()
+    app.add_route("/metrics", monitoring.MetricsExposition().endpoint)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        compressed = await client.get("/metrics", headers={"Accept-Encoding": "gzip"})
+        plain = await client.get("/metrics", headers={"Accept-Encoding": "identity"})
+
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert "Content-Encoding" not in plain.headers
+    assert compressed.text == plain.text
+    assert "fastapi_app_info" in plain.text
+
+
+@pytest.mark.asyncio
+async def test_metrics_exposition_compresses_once(mocker):
+    exposition = monitoring.MetricsExposition(interval=60, compress=True)
+    compress = mocker.spy(monitoring.gzip, "compress")
+
+    bodies = await asyncio.gather(*(exposition.get_body(compressed=True) for _ in range(5)))
+
+    assert len(set(bodies)) == 1
+    assert compress.call_count == 1
+
+
+def test_metrics_exposition_settings(mocker):
+    mocker.patch.object(
+        monitoring,
+        "get_metrics_settings",
+        return_value=config.MetricsSettings(METRICS_CACHE_INTERVAL=30, METRICS_GZIP=False),
+    )
+
+    exposition = monitoring.MetricsExposition()
+    assert (exposition.interval, exposition.compress) == (30, False)
+    assert monitoring.MetricsExposition(interval=0, compress=True).interval == 0
+
+
+def test_tail_span_processor_keeps_errors_and_slow_spans():
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider(sampler=monitoring.RecordingSampler(ParentBasedTraceIdRatio(0)))
+    provider.add_span_processor(
+        monitoring.TailSpanProcessor(SimpleSpanProcessor(exporter), keep_errors=True, slow_threshold=1)
+    )
+    tracer = provider.get_tracer(__name__)
+
+    tracer.start_span("fast", start_time=0).end(end_time=10**8)
+    tracer.start_span("slow", start_time=0).end(end_time=2 * 10**9)
+    with tracer.start_as_current_span("failed", record_exception=False, set_status_on_exception=False) as span:
+        span.set_status(Status(StatusCode.ERROR))
+    provider.force_flush()
+
+    spans = exporter.get_finished_spans()
+    assert sorted(span.name for span in spans) == ["failed", "slow"]
+    assert all(span.context.trace_flags.sampled for span in spans)
+
+
+def test_setting_otlp(mocker):
+    set_tracer_provider = mocker.patch.object(monitoring.trace, "set_tracer_provider")
+    mocker.patch.object(monitoring, "OTLPSpanExporter", return_value=InMemorySpanExporter())
+    instrument_app = mocker.patch.object(monitoring.FastAPIInstrumentor, "instrument_app")
+    mocker.patch.object(
+        monitoring,
+        "get_metrics_settings",
+        return_value=config.MetricsSettings(OTLP_SAMPLE_RATIO=0.2, OTLP_KEEP_ERRORS=True, OTLP_EXCLUDED_URLS="/skip"),
+    )
+
+    monitoring.setting_otlp(None, "test-otlp", "http://tempo:4317", log_correlation=False)
+    tracer = set_tracer_provider.call_args.args[0]
+    assert isinstance(tracer.sampler, monitoring.RecordingSampler)
+    assert tracer.sampler.root.get_description() == ParentBasedTraceIdRatio(0.2).get_description()
+    assert instrument_app.call_args.kwargs["excluded_urls"] == "/skip"
+    tracer.shutdown()
+
+    monitoring.setting_otlp(None, "test-otlp", "http://tempo:4317", log_correlation=False, keep_errors=False)
+    tracer = set_tracer_provider.call_args.args[0]
+    assert isinstance(tracer.sampler, ParentBasedTraceIdRatio)
+    tracer.shutdown()
@@ -1,10 +1,44 @@
+import asyncio
 import logging
+from functools import partial
 from unittest.mock import AsyncMock, MagicMock
 
+import httpx
 import pytest
+import strawberry
+from opentelemetry.sdk.trace import TracerProvider
+from prometheus_client import REGISTRY
+from fastapi import FastAPI, Request
+from strawberry.http import GraphQLRequestData
+from strawberry.schema.config import StrawberryConfig
 from strawberry.types import ExecutionResult
 
-from lcaplatform_config.router import LCAGraphQLRouter
+from lcaplatform_config.router import LCAGraphQLRouter, ProfilingExtension, parse_operation
+
+
+@strawberry.type
+class ProfiledItem:
+    id: int
+
+    @strawberry.field
+    async def detail(self) -> str:
+        await asyncio.sleep(0)
+        return f"detail {self.id}"
+
+
+@strawberry.type
+class ProfiledQuery:
+    @strawberry.field
+    def profiled_items(self) -> list[ProfiledItem]:
+        return [ProfiledItem(id=index) for index in range(5)]
+
+
+def profiled_schema(**options) -> strawberry.Schema:
+    return strawberry.Schema(ProfiledQuery, extensions=[partial(ProfilingExtension, **options)])
+
+
+def sample(name: str, **labels: str) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
 
 
 @pytest.fixture
@@ -37,8 +71,8 @@ def error_response(mocker) -> MagicMock:
 
 
 @pytest.fixture
-def mock_request_0(mocker) -> MagicMock:
-    """Mock out fastapi.Request.json method to return the query dict
+def mock_request_0(mocker, mock_response, error_response) -> MagicMock:
+    """Mock out fastapi.Request with the request data Strawberry parsed
 
     Query does not contain variables.
     """
@@ -50,17 +84,17 @@ def mock_request_0(mocker) -> MagicMock:
             }
         }
     """
-    response = {"query": query, "variables": None}
-    json_mock = AsyncMock(return_value=response)
+    request_data = GraphQLRequestData(query=query, variables=None, operation_name=None, extensions=None)
     request_mock = mocker.patch("fastapi.Request")
     request_mock.state.user.preferred_username = "user@mail.com"
-    request_mock.json = json_mock
+    request_mock.state.graphql_requests = {id(mock_response): request_data, id(error_response): request_data}
+    request_mock.json = AsyncMock(side_effect=AssertionError("the request body is decoded again"))
     yield request_mock
 
 
 @pytest.fixture
-def mock_request_1(mocker) -> MagicMock:
-    """Mock out fastapi.Request.json method to return the query dict
+def mock_request_1(mocker, mock_response, error_response) -> MagicMock:
+    """Mock out fastapi.Request with the request data Strawberry parsed
 
     Query contains variables.
     """
@@ -72,11 +106,13 @@ def mock_request_1(mocker) -> MagicMock:
             __typename
         }
     }"""
-    response = {"query": query, "variables": {"projectId": "COWI ATR"}}
-    json_mock = AsyncMock(return_value=response)
+    request_data = GraphQLRequestData(
+        query=query, variables={"projectId": "COWI ATR"}, operation_name="getArkitemaProject", extensions=None
+    )
     request_mock = mocker.patch("fastapi.Request")
     request_mock.state.user.preferred_username = "user@mail.com"
-    request_mock.json = json_mock
+    request_mock.state.graphql_requests = {id(mock_response): request_data, id(error_response): request_data}
+    request_mock.json = AsyncMock(side_effect=AssertionError("the request body is decoded again"))
     yield request_mock
 
 
@@ -120,3 +156,82 @@ async def test_router_logs_graphql_path_with_error(
         log.message
         == 'User: "user@mail.com", GraphQL path: "/path", msg: "error", vars: "{\'projectId\': \'COWI ATR\'}"'
     )
+
+
+@pytest.mark.asyncio
+async def test_profiling_extension(caplog):
+    phases = ("operation", "parse", "validation", "execution")
+    before = {phase: sample("graphql_phase_duration_seconds_count", phase=phase) for phase in phases}
+    detail_before = sample("graphql_resolver_duration_seconds_count", resolver="ProfiledItem.detail")
+    items_before = sample("graphql_resolver_duration_seconds_count", resolver="ProfiledQuery.profiledItems")
+    n_plus_one_before = sample("graphql_n_plus_one_total", resolver="ProfiledItem.detail")
+    tracer = TracerProvider().get_tracer(__name__)
+
+    with tracer.start_as_current_span("request") as span, caplog.at_level(logging.WARNING):
+        result = await profiled_schema(sample_rate=1, n_plus_one_threshold=3).execute(
+            "query Items { profiledItems { id detail } }"
+        )
+
+    assert result.errors is None
+    assert len(result.data["profiledItems"]) == 5
+    for phase in phases:
+        assert sample("graphql_phase_duration_seconds_count", phase=phase) == before[phase] + 1
+    assert sample("graphql_resolver_duration_seconds_count", resolver="ProfiledItem.detail") == detail_before + 5
+    assert sample("graphql_resolver_duration_seconds_count", resolver="ProfiledQuery.profiledItems") == items_before + 1
+    assert sample("graphql_n_plus_one_total", resolver="ProfiledItem.detail") == n_plus_one_before + 1
+    assert 'resolver "ProfiledItem.detail" was called 5 times' in caplog.text
+
+    assert span.attributes["graphql.operation.name"] == "Items"
+    assert span.attributes["graphql.resolver.ProfiledItem.detail.calls"] == 5
+    assert span.attributes["graphql.n_plus_one"] == ("ProfiledItem.detail",)
+    assert span.attributes["graphql.operation.duration"] >= span.attributes["graphql.execution.duration"]
+
+
+@pytest.mark.asyncio
+async def test_profiling_extension_sampling():
+    before = sample("graphql_phase_duration_seconds_count", phase="operation")
+
+    result = await profiled_schema(sample_rate=0).execute("{ profiledItems { detail } }")
+
+    assert result.errors is None
+    assert sample("graphql_phase_duration_seconds_count", phase="operation") == before
+
+
+def test_parse_operation():
+    query = """
+        query first { tags { id } }
+        mutation second($name: String!) { renamed: addTag(name: $name) { id } }
+    """
+
+    assert parse_operation(query) == ("first", "tags")
+    assert parse_operation(query, "second") == ("second", "addTag")
+    assert parse_operation("{ tags { id } }") == (None, "tags")
+    assert parse_operation("query {") == (None, "")
+
+
+@pytest.mark.asyncio
+async def test_router_logs_get_and_batched_requests(mocker, caplog):
+    schema = strawberry.Schema(ProfiledQuery, config=StrawberryConfig(batching_config={"max_operations": 5}))
+    app = FastAPI()
+    app.include_router(LCAGraphQLRouter(schema), prefix="/graphql")
+    request_json = mocker.spy(Request, "json")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        with caplog.at_level(logging.INFO):
+            get = await client.get("/graphql", params={"query": "query Items { profiledItems { id } }"})
+            batch = await client.post(
+                "/graphql",
+                json=[
+                    {"query": "{ profiledItems { id } }"},
+                    {"query": "query Other { __typename }", "variables": {"a": 1}},
+                ],
+            )
+
+    assert get.status_code == batch.status_code == 200
+    messages = [record.message for record in caplog.records if record.funcName == "process_result"]
+    assert messages == [
+        'User: "", GraphQL path: "profiledItems", vars: "None"',
+        'User: "", GraphQL path: "profiledItems", vars: "None"',
+        'User: "", GraphQL path: "__typename", vars: "{\'a\': 1}"',
+    ]
+    request_json.assert_not_called()
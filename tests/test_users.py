@@ -1,6 +1,12 @@
+import asyncio
 import datetime
+import time
+from collections import OrderedDict
 
 import pytest
+from kiota_abstractions.api_error import APIError
+from msgraph.generated.models.sign_in_activity import SignInActivity
+from msgraph.generated.models.user import User
 
 from lcaplatform_config import exceptions, user
 
@@ -14,9 +20,9 @@ async def test_get_aad_user_by_email(mock_graph_client):
     assert len(mock_graph_client.mock_calls) == 3
     # GraphServiceClient(...)
     assert mock_graph_client.call_count == 1
-    assert mock_graph_client.mock_calls[0][2]["scopes"] == ["https://graph.microsoft.com/.default"]
-    # graph.users.by_user_id(...)
-    assert mock_graph_client.mock_calls[1][1][0] == "test@email.com"
+    assert mock_graph_client.auth_provider.call_args.kwargs["scopes"] == ["https://graph.microsoft.com/.default"]
+    # graph.users.by_user_id(...), email.com is an external domain
+    assert mock_graph_client.mock_calls[1][1][0] == f"test_email.com#EXT#@{user.settings.DEFAULT_AD_FQDN}"
     # graph.users.by_user_id(...).get()
     assert mock_graph_client.mock_calls[2][1] == ()
 
@@ -34,6 +40,15 @@ async def test_get_aad_user_by_email_with_cache(mock_graph_client):
     assert mock_graph_client.mock_calls == []
 
 
+@pytest.mark.asyncio
+async def test_get_aad_user_by_email_concurrent(mock_graph_client):
+    results = await asyncio.gather(*(user.get_aad_user_by_email("test@email.com") for _ in range(3)))
+
+    assert [result.id for result in results] == ["123"] * 3
+    assert mock_graph_client.call_count == 1
+    assert mock_graph_client.graph_client_obj.users.by_user_id.return_value.get.await_count == 1
+
+
 @pytest.mark.asyncio
 async def test_invite_user_to_add(mock_graph_client):
     result = await user.invite_user_to_aad("test@email.com", "platform", "https://lca-platform.com/")
@@ -42,7 +57,7 @@ async def test_invite_user_to_add(mock_graph_client):
     assert len(mock_graph_client.mock_calls) == 2
     # GraphServiceClient(...)
     assert mock_graph_client.call_count == 1
-    assert mock_graph_client.mock_calls[0][2]["scopes"] == ["https://graph.microsoft.com/.default"]
+    assert mock_graph_client.auth_provider.call_args.kwargs["scopes"] == ["https://graph.microsoft.com/.default"]
     # graph.invitations.post(....)
     assert len(mock_graph_client.mock_calls[1][1]) == 1
     assert mock_graph_client.mock_calls[1][1][0].invited_user_email_address == "test@email.com"
@@ -64,7 +79,7 @@ async def test_get_users_from_azure(mock_graph_client):
     assert len(mock_graph_client.mock_calls) == 3
     # GraphServiceClient(...)
     assert mock_graph_client.call_count == 1
-    assert mock_graph_client.mock_calls[0][2]["scopes"] == ["https://graph.microsoft.com/.default"]
+    assert mock_graph_client.auth_provider.call_args.kwargs["scopes"] == ["https://graph.microsoft.com/.default"]
     # graph.users.by_user_id(...)
     assert mock_graph_client.mock_calls[1][1][0] == "123"
     # graph.users.by_user_id(...).get()
@@ -88,3 +103,386 @@ async def test_get_users_from_azure_with_cache(mock_graph_client):
     assert result == ["test_user"]
 
     assert len(mock_graph_client.mock_calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_users_from_azure_partial_failure(mock_graph_client, mocker):
+    get_mock = mock_graph_client.graph_client_obj.users.by_user_id.return_value.get
+    return_user = get_mock.return_value
+    get_mock.side_effect = [return_user, exceptions.MSGraphException]
+
+    result = await user.get_users_from_azure(["123", "456"])
+
+    assert [item["user_id"] for item in result] == ["123"]
+    assert await user.cache.get("456", namespace="azure_users") is None
+
+
+@pytest.mark.asyncio
+async def test_get_users_from_azure_retries_throttled(mock_graph_client, mocker):
+    get_mock = mock_graph_client.graph_client_obj.users.by_user_id.return_value.get
+    throttled = APIError(response_status_code=429, response_headers={"Retry-After": "0.01"})
+    get_mock.side_effect = [throttled, get_mock.return_value]
+    sleep_mock = mocker.spy(user.asyncio, "sleep")
+
+    result = await user.get_users_from_azure("123")
+
+    assert result[0]["user_id"] == "123"
+    assert get_mock.await_count == 2
+    sleep_mock.assert_awaited_once_with(0.01)
+
+
+@pytest.mark.asyncio
+async def test_get_users_from_azure_retry_delay_too_long(mock_graph_client, mocker):
+    get_mock = mock_graph_client.graph_client_obj.users.by_user_id.return_value.get
+    get_mock.side_effect = APIError(response_status_code=429, response_headers={"Retry-After": "600"})
+    sleep_mock = mocker.spy(user.asyncio, "sleep")
+
+    with pytest.raises(exceptions.MSGraphException):
+        await user.get_users_from_azure("123")
+
+    assert get_mock.await_count == 1
+    sleep_mock.assert_not_awaited()
+
+
+def test_retry_delay(settings_env):
+    assert user.retry_delay(APIError(response_headers={"retry-after": "7"}), attempt=0) == 7
+    assert user.retry_delay(APIError(response_headers={"Retry-After": {"3"}}), attempt=0) == 3
+    assert user.retry_delay(APIError(), attempt=2) == user.settings.GRAPH_RETRY_BACKOFF * 4
+
+
+def stand_in_user(user_id: str) -> dict:
+    return {
+        "id": user_id,
+        "displayName": f"User {user_id}",
+        "mail": f"{user_id}@example.com",
+        "companyName": "Example",
+        "signInActivity": {"lastSignInDateTime": "2024-01-02T03:04:05Z"},
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_users_from_azure_batch(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "GRAPH_BATCH_SIZE", 20)
+    user_ids = [f"user-{index}" for index in range(45)]
+    graph_stand_in.stand_in_users.update({user_id: stand_in_user(user_id) for user_id in user_ids})
+
+    result = await user.get_users_from_azure(user_ids)
+
+    assert sorted(graph_stand_in.stand_in_requests) == [
+        ("POST", "/v1.0/$batch", 5),
+        ("POST", "/v1.0/$batch", 20),
+        ("POST", "/v1.0/$batch", 20),
+    ]
+    assert [item["user_id"] for item in result] == user_ids
+    assert result[0] == {
+        "user_id": "user-0",
+        "name": "User user-0",
+        "email": "user-0@example.com",
+        "company": "Example",
+        "last_login": datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_users_from_azure_batch_item_fallback(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "GRAPH_BATCH_SIZE", 20)
+    graph_stand_in.stand_in_users.update({"123": stand_in_user("123"), "456": stand_in_user("456")})
+    graph_stand_in.stand_in_failing_items["456"] = [500]
+
+    result = await user.get_users_from_azure(["123", "456", "789"])
+
+    assert [item["user_id"] for item in result] == ["123", "456"]
+    # the missing user isn't fetched again
+    assert graph_stand_in.stand_in_requests == [("POST", "/v1.0/$batch", 3), ("GET", "/v1.0/users/456", 1)]
+
+
+@pytest.mark.asyncio
+async def test_get_users_from_azure_batch_item_throttled(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "GRAPH_BATCH_SIZE", 20)
+    graph_stand_in.stand_in_users.update({"123": stand_in_user("123"), "456": stand_in_user("456")})
+    graph_stand_in.stand_in_failing_items["456"] = [429, 503]
+
+    result = await user.get_users_from_azure(["123", "456"])
+
+    assert [item["user_id"] for item in result] == ["123", "456"]
+    # only the throttled user is batched again, nothing is fetched one by one
+    assert graph_stand_in.stand_in_requests == [
+        ("POST", "/v1.0/$batch", 2),
+        ("POST", "/v1.0/$batch", 1),
+        ("POST", "/v1.0/$batch", 1),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_users_from_azure_batch_item_throttled_exhausted(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "GRAPH_BATCH_SIZE", 20)
+    mocker.patch.object(user.settings, "GRAPH_MAX_RETRIES", 1)
+    graph_stand_in.stand_in_users.update({"123": stand_in_user("123"), "456": stand_in_user("456")})
+    graph_stand_in.stand_in_failing_items["456"] = [429] * 5
+
+    result = await user.get_users_from_azure(["123", "456"])
+
+    assert [item["user_id"] for item in result] == ["123"]
+    assert graph_stand_in.stand_in_requests == [("POST", "/v1.0/$batch", 2), ("POST", "/v1.0/$batch", 1)]
+
+
+@pytest.mark.asyncio
+async def test_get_users_from_azure_batch_item_retry_delay_too_long(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "GRAPH_BATCH_SIZE", 20)
+    graph_stand_in.stand_in_users.update({"123": stand_in_user("123"), "456": stand_in_user("456")})
+    graph_stand_in.stand_in_failing_items["456"] = [429]
+    mocker.patch.object(user, "retry_delay", return_value=600)
+    sleep_mock = mocker.spy(user.asyncio, "sleep")
+
+    result = await user.get_users_from_azure(["123", "456"])
+
+    assert [item["user_id"] for item in result] == ["123"]
+    assert graph_stand_in.stand_in_requests == [("POST", "/v1.0/$batch", 2)]
+    sleep_mock.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_get_users_from_azure_batch_failure_fallback(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "GRAPH_BATCH_SIZE", 20)
+    mocker.patch.object(user.settings, "GRAPH_MAX_RETRIES", 0)
+    graph_stand_in.stand_in_users.update({"123": stand_in_user("123"), "456": stand_in_user("456")})
+    graph_stand_in.stand_in_failing_batches.append(503)
+
+    result = await user.get_users_from_azure(["123", "456"])
+
+    assert [item["user_id"] for item in result] == ["123", "456"]
+    assert sorted(graph_stand_in.stand_in_requests) == [
+        ("GET", "/v1.0/users/123", 1),
+        ("GET", "/v1.0/users/456", 1),
+        ("POST", "/v1.0/$batch", 2),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_users_from_azure_retries_are_not_stacked(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "GRAPH_BATCH_SIZE", 1)
+    mocker.patch.object(user.settings, "GRAPH_MAX_RETRIES", 1)
+    graph_stand_in.stand_in_users.update({"123": stand_in_user("123"), "456": stand_in_user("456")})
+    graph_stand_in.stand_in_failing_requests["456"] = [429] * 10
+
+    result = await user.get_users_from_azure(["123", "456"])
+
+    assert [item["user_id"] for item in result] == ["123"]
+    # only the retry of with_retries, none of the client's retry handler
+    assert graph_stand_in.stand_in_requests.count(("GET", "/v1.0/users/456", 1)) == 2
+
+
+@pytest.mark.asyncio
+async def test_graph_client_is_shared(mock_graph_client):
+    await user.get_aad_user_by_email("test@email.com")
+    await user.get_users_from_azure("123")
+
+    assert mock_graph_client.call_count == 1
+    assert user.get_graph_client() is mock_graph_client.graph_client_obj
+    assert user.get_credentials() is mock_graph_client.auth_provider.call_args.args[0]
+
+
+@pytest.mark.asyncio
+async def test_graph_client_dispose(mock_graph_client, mocker):
+    graph = user.get_graph_client()
+    aclose_mock = mocker.patch.object(user._http_client, "aclose")
+    credentials = user.get_credentials()
+    close_mock = mocker.patch.object(credentials, "close")
+
+    await user.dispose()
+
+    aclose_mock.assert_awaited_once()
+    close_mock.assert_awaited_once()
+    assert user.get_graph_client() is graph  # the patched class returns the same object
+    assert mock_graph_client.call_count == 2
+
+
+def test_graph_client_closed_on_loop_change(mock_graph_client, mocker):
+    async def create_client() -> None:
+        user.get_graph_client()
+
+    asyncio.run(create_client())
+    http_client, credentials = user._http_client, user._credentials
+    aclose_mock = mocker.patch.object(http_client, "aclose")
+    close_mock = mocker.patch.object(credentials, "close")
+
+    async def create_client_on_new_loop() -> None:
+        user.get_graph_client()
+        await asyncio.gather(*user._closing)
+
+    asyncio.run(create_client_on_new_loop())
+
+    assert user._http_client is not http_client
+    aclose_mock.assert_awaited_once()
+    close_mock.assert_awaited_once()
+    assert mock_graph_client.call_count == 2
+
+
+def test_user_serializer_round_trip():
+    serializer = user.UserSerializer()
+    last_login = datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    graph_user = User(
+        id="123",
+        display_name="Test",
+        mail="test@email.com",
+        sign_in_activity=SignInActivity(last_sign_in_date_time=last_login),
+    )
+
+    dumped = serializer.dumps(graph_user)
+    loaded = serializer.loads(dumped)
+
+    assert "businessPhones" not in dumped and " " not in dumped
+    assert isinstance(loaded, User)
+    assert (loaded.id, loaded.display_name, loaded.mail) == ("123", "Test", "test@email.com")
+    assert loaded.sign_in_activity.last_sign_in_date_time == last_login
+
+    user_dict = user.user_to_dict(graph_user)
+    assert serializer.loads(serializer.dumps(user_dict)) == user_dict
+    assert serializer.loads(None) is None
+
+
+@pytest.mark.asyncio
+async def test_user_cache_shared_backend(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "USER_CACHE_URL", "memory://")
+    mocker.patch.object(user.settings, "AZURE_USERS_CACHE_TTL", 120)
+    worker_1, worker_2 = user.create_user_cache(), user.create_user_cache()
+    assert isinstance(worker_1.backend.serializer, user.UserSerializer)
+    worker_2.backend = worker_1.backend  # the fake stands in for one Redis shared by both workers
+    graph_stand_in.stand_in_users.update({"123": stand_in_user("123")})
+
+    mocker.patch.object(user, "cache", worker_1)
+    first = await user.get_users_from_azure("123")
+    mocker.patch.object(user, "cache", worker_2)
+    second = await user.get_users_from_azure("123")
+
+    assert first == second
+    assert graph_stand_in.stand_in_requests == [("GET", "/v1.0/users/123", 1)]
+    assert worker_2.local.get(("azure_users", "123")) == first[0]
+    await worker_1.backend.close()
+
+
+@pytest.mark.asyncio
+async def test_user_cache_hit_not_written_to_backend(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "USER_CACHE_URL", "memory://")
+    mocker.patch.object(user, "cache", user.create_user_cache())
+    graph_stand_in.stand_in_users.update({user_id: stand_in_user(user_id) for user_id in ("1", "2")})
+    await user.get_users_from_azure(["1"])
+    multi_set_mock = mocker.spy(user.cache.backend, "multi_set")
+
+    await user.get_users_from_azure(["1", "2"])
+    multi_set_mock.assert_awaited_once()
+    assert [key for key, _ in multi_set_mock.call_args.args[0]] == ["2"]
+
+    multi_set_mock.reset_mock()
+    await user.get_users_from_azure(["1", "2"])
+    multi_set_mock.assert_not_awaited()
+    await user.cache.backend.close()
+
+
+@pytest.mark.asyncio
+async def test_users_refresh_ahead(graph_stand_in, mocker):
+    mocker.patch.object(user.users_refresher, "_entries", OrderedDict())
+    mocker.patch.object(user.users_refresher, "enabled", True)
+    graph_stand_in.stand_in_users.update({user_id: stand_in_user(user_id) for user_id in ("1", "2", "3")})
+    await user.get_users_from_azure(["1", "2", "3"])
+    await user.get_users_from_azure(["1", "2"])
+    graph_stand_in.stand_in_users["1"]["displayName"] = "Renamed"
+
+    monotonic = time.monotonic
+    mocker.patch(
+        "lcaplatform_config.cache.time.monotonic", lambda: monotonic() + user.settings.AZURE_USERS_CACHE_TTL - 30
+    )
+    assert await user.users_refresher.refresh() == 2
+
+    assert graph_stand_in.stand_in_requests == [("POST", "/v1.0/$batch", 3), ("POST", "/v1.0/$batch", 2)]
+    result = await user.get_users_from_azure(["1", "2"])
+    assert [item["name"] for item in result] == ["Renamed", "User 2"]
+    assert len(graph_stand_in.stand_in_requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_refresh_ahead_started_on_startup(mock_graph_client, mocker):
+    mocker.patch.object(user.settings, "USER_REFRESH_AHEAD", True)
+    mocker.patch.object(user.settings, "USER_REFRESH_INTERVAL", 0.01)
+    refresh_mock = mocker.patch.object(user.RefreshAhead, "refresh")
+
+    await user.startup()
+    await asyncio.sleep(0.05)
+    tasks = list(user._refresh_tasks)
+    user.get_graph_client()
+    mocker.patch.object(user._http_client, "aclose")
+    mocker.patch.object(user.get_credentials(), "close")
+    await user.dispose()
+
+    assert len(tasks) == 2 and all(task.cancelled() for task in tasks)
+    assert user._refresh_tasks == []
+    assert refresh_mock.await_count >= 2
+
+
+@pytest.mark.parametrize(
+    "domains",
+    ["arkitema,cowi,cowicloud", ["arkitema", "cowi", "cowicloud"]],
+)
+def test_principal_name(domains, mocker):
+    mocker.patch.object(user.settings, "INTERNAL_EMAIL_DOMAINS_LIST", domains)
+    mocker.patch.object(user.settings, "DEFAULT_AD_FQDN", "cowi.onmicrosoft.com")
+
+    assert user.is_internal_email("jane@cowi.com")
+    assert user.is_internal_email("jane@CowiCloud.dk")
+    assert not user.is_internal_email("cowi.fan@gmail.com")
+    assert user.principal_name("jane@arkitema.com") == "jane@arkitema.com"
+    assert user.principal_name("jane@gmail.com") == "jane_gmail.com#EXT#@cowi.onmicrosoft.com"
+
+
+@pytest.mark.asyncio
+async def test_get_aad_users_by_emails(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "GRAPH_BATCH_SIZE", 20)
+    mocker.patch.object(user.settings, "DEFAULT_AD_FQDN", "cowi.onmicrosoft.com")
+    graph_stand_in.stand_in_users.update(
+        {
+            "jane@cowi.com": stand_in_user("1"),
+            "joe_gmail.com#EXT#@cowi.onmicrosoft.com": stand_in_user("2"),
+        }
+    )
+    await user.cache.set("cached@cowi.com", User(id="3"), namespace="azure_emails")
+
+    result = await user.get_aad_users_by_emails(
+        ["jane@cowi.com", "joe@gmail.com", "cached@cowi.com", "jane@cowi.com", "nobody@cowi.com"]
+    )
+
+    assert list(result) == ["jane@cowi.com", "joe@gmail.com", "cached@cowi.com", "nobody@cowi.com"]
+    assert [found.id if found else None for found in result.values()] == ["1", "2", "3", None]
+    assert graph_stand_in.stand_in_requests == [("POST", "/v1.0/$batch", 3)]
+    assert (await user.cache.get("joe@gmail.com", namespace="azure_emails")).id == "2"
+
+    await user.get_aad_users_by_emails(["joe@gmail.com", "jane@cowi.com"])
+    assert len(graph_stand_in.stand_in_requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_email_lookups_fetch_the_same_fields(graph_stand_in, mocker):
+    mocker.patch.object(user.settings, "GRAPH_BATCH_SIZE", 20)
+    for user_id in ("1", "2", "3"):
+        graph_stand_in.stand_in_users[f"{user_id}@cowi.com"] = {**stand_in_user(user_id), "givenName": "Jane"}
+
+    single = await user.get_aad_user_by_email("1@cowi.com")
+    batch = await user.get_aad_users_by_emails(["2@cowi.com", "3@cowi.com"])
+    refreshed = await user.refresh_users_by_emails(["1@cowi.com"])
+
+    assert single.given_name == "Jane"
+    assert [found.given_name for found in batch.values()] == ["Jane", "Jane"]
+    assert refreshed["1@cowi.com"].given_name == "Jane"
+
+
+@pytest.mark.asyncio
+async def test_get_aad_users_by_emails_failed(graph_stand_in, mocker):
+    fetch_mock = mocker.patch.object(user, "fetch_users_from_azure")
+    fetch_mock.return_value = {"jane@cowi.com": User(id="1"), "joe@cowi.com": APIError(response_status_code=500)}
+
+    result = await user.get_aad_users_by_emails(["jane@cowi.com", "joe@cowi.com"])
+    assert result["jane@cowi.com"].id == "1" and result["joe@cowi.com"] is None
+    assert await user.cache.get("joe@cowi.com", namespace="azure_emails") is None
+
+    fetch_mock.return_value = {"joe@cowi.com": APIError(response_status_code=500)}
+    with pytest.raises(exceptions.MSGraphException):
+        await user.get_aad_users_by_emails(["joe@cowi.com"])
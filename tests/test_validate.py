@@ -1,3 +1,9 @@
+import asyncio
+import base64
+import json
+import time
+
+import httpx
 import pytest
 from pytest_httpx import HTTPXMock
 
@@ -61,3 +67,150 @@ async def test_group_doesnt_exist(httpx_mock: HTTPXMock):
     check = await validate.group_exists("projectId0", "badGroup", "mytoken")
 
     assert check is False
+
+
+async def test_router_client_is_shared(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(url=f"{settings.ROUTER_URL}/graphql", json={"data": {"projects": []}}, is_reusable=True)
+
+    await validate.project_exists("sharedClientProject", "token0")
+    client = validate.get_client()
+    await validate.group_exists("sharedClientProject", "group0", "token1")
+
+    assert validate.get_client() is client
+    assert [request.headers["authorization"] for request in httpx_mock.get_requests()] == [
+        "Bearer token0",
+        "Bearer token1",
+    ]
+    assert "authorization" not in client.headers
+
+    await validate.dispose()
+    assert client.is_closed
+    assert validate.get_client() is not client
+
+    await validate.dispose()
+
+
+def test_router_client_closed_on_loop_change(mocker):
+    async def create_client() -> httpx.AsyncClient:
+        return validate.get_client()
+
+    client = asyncio.run(create_client())
+    aclose_mock = mocker.patch.object(client, "aclose")
+
+    async def create_client_on_new_loop() -> httpx.AsyncClient:
+        new_client = validate.get_client()
+        await asyncio.gather(*validate._closing)
+        return new_client
+
+    assert asyncio.run(create_client_on_new_loop()) is not client
+    aclose_mock.assert_awaited_once()
+    assert not validate._closing
+    asyncio.run(validate.dispose())
+
+
+async def test_project_exists_batched(httpx_mock: HTTPXMock):
+    mock_data = {"data": {"projects": [{"id": "batchProject0", "public": False}]}}
+    httpx_mock.add_response(url=f"{settings.ROUTER_URL}/graphql", json=mock_data)
+
+    checks = await asyncio.gather(
+        validate.project_exists("batchProject0", "batchToken"),
+        validate.project_exists("batchProject1", "batchToken"),
+    )
+
+    assert checks == [{"projects": [{"id": "batchProject0", "public": False}]}, {"projects": []}]
+    (request,) = httpx_mock.get_requests()
+    assert json.loads(request.content)["variables"] == {"ids": ["batchProject0", "batchProject1"]}
+
+
+async def test_group_exists_batched(httpx_mock: HTTPXMock):
+    mock_data = {
+        "data": {"project0": [{"id": "batchGroup0"}], "project1": None},
+        "errors": [{"message": "error", "path": ["project1"]}],
+    }
+    httpx_mock.add_response(url=f"{settings.ROUTER_URL}/graphql", json=mock_data)
+
+    checks = await asyncio.gather(
+        validate.group_exists("batchProject0", "batchGroup0", "batchToken"),
+        validate.group_exists("batchProject0", "batchGroup1", "batchToken"),
+        validate.group_exists("batchProject1", "batchGroup2", "batchToken"),
+    )
+
+    assert checks == [True, True, False]
+    (request,) = httpx_mock.get_requests()
+    assert json.loads(request.content)["variables"] == {
+        "project0Id": "batchProject0",
+        "project0GroupIds": ["batchGroup0", "batchGroup1"],
+        "project1Id": "batchProject1",
+        "project1GroupIds": ["batchGroup2"],
+    }
+
+
+def make_token(claims: dict) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+def test_token_subject():
+    assert validate.token_subject(make_token({"oid": "user-oid", "sub": "user-sub"})) == "user-oid"
+    assert validate.token_subject(make_token({"sub": "user-sub"})) == "user-sub"
+    assert validate.token_subject("opaque") == validate.token_subject("opaque") != validate.token_subject("other")
+
+
+async def test_project_exists_cached_per_user(httpx_mock: HTTPXMock):
+    mock_data = {"data": {"projects": [{"id": "userCacheProject", "public": True}]}}
+    httpx_mock.add_response(url=f"{settings.ROUTER_URL}/graphql", json=mock_data)
+
+    first = await validate.project_exists("userCacheProject", make_token({"oid": "userCache", "exp": 1}))
+    refreshed = await validate.project_exists("userCacheProject", token=make_token({"oid": "userCache", "exp": 2}))
+
+    assert first == refreshed
+    assert len(httpx_mock.get_requests()) == 1
+
+
+async def test_group_exists_negative_ttl(httpx_mock: HTTPXMock, mocker):
+    httpx_mock.add_response(url=f"{settings.ROUTER_URL}/graphql", json={"errors": [{"message": "error"}]})
+    set_mock = mocker.spy(validate.permission_cache, "set")
+
+    assert await validate.group_exists("negativeProject", "negativeGroup", "negativeToken") is False
+    assert await validate.group_exists("negativeProject", "negativeGroup", "negativeToken") is False
+
+    assert len(httpx_mock.get_requests()) == 1
+    assert set_mock.call_args.kwargs["ttl"] == settings.PERMISSION_CACHE_NEGATIVE_TTL
+
+
+async def test_project_exists_non_member_negative_ttl(httpx_mock: HTTPXMock, mocker):
+    httpx_mock.add_response(url=f"{settings.ROUTER_URL}/graphql", json={"data": {"projects": []}})
+    set_mock = mocker.spy(validate.permission_cache, "set")
+
+    assert await validate.project_exists("nonMemberProject", "nonMemberToken") == {"projects": []}
+    assert await validate.project_exists("nonMemberProject", "nonMemberToken") == {"projects": []}
+
+    assert len(httpx_mock.get_requests()) == 1
+    assert set_mock.call_args.kwargs["ttl"] == settings.PERMISSION_CACHE_NEGATIVE_TTL
+
+
+async def test_project_exists_member_positive_ttl(httpx_mock: HTTPXMock, mocker):
+    projects = [{"id": "memberProject", "public": False}]
+    httpx_mock.add_response(url=f"{settings.ROUTER_URL}/graphql", json={"data": {"projects": projects}})
+    set_mock = mocker.spy(validate.permission_cache, "set")
+
+    assert await validate.project_exists("memberProject", "memberToken") == {"projects": projects}
+
+    assert set_mock.call_args.kwargs["ttl"] == settings.PERMISSION_CACHE_TTL
+
+
+async def test_project_exists_stale_while_revalidate(httpx_mock: HTTPXMock, mocker):
+    mocker.patch.object(validate.settings, "PERMISSION_CACHE_STALE_TTL", 60)
+    httpx_mock.add_response(url=f"{settings.ROUTER_URL}/graphql", json={"data": {"projects": []}}, is_reusable=True)
+
+    check = await validate.project_exists("staleProject", "staleToken")
+    # the event loop uses the same clock, so move it forward instead of freezing it
+    monotonic = time.monotonic
+    mocker.patch("time.monotonic", lambda: monotonic() + settings.PERMISSION_CACHE_TTL)
+
+    assert await validate.project_exists("staleProject", "staleToken") == check
+    assert len(validate.permission_flights) == 1
+    await asyncio.sleep(0.01)
+
+    assert len(validate.permission_flights) == 0
+    assert len(httpx_mock.get_requests()) == 2